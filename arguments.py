@@ -22,27 +22,71 @@ def get_args():
     parser.add_argument('--dataset_split', type=str, default='validation', choices=['train', 'validation', 'test'])
     parser.add_argument('--dataset', type=str, default='./data/val.json')
     parser.add_argument('--retrieval_dataset', type=str, default='./data/train.json')
-    parser.add_argument('--example_idx_file', type=str, default=None)
+    parser.add_argument('--example_idx_file', type=str, default=None)   # json task -> retrieved examplar indices, built with --retrieval_index if missing or stale
+    parser.add_argument('--retrieval_index', type=str, default=None)    # .npz embeddings of the retrieval dataset tasks, None for fixed examplars
+    parser.add_argument('--retrieval_model', type=str, default='stsb-roberta-large')
     parser.add_argument('--api_keys_file', type=str, default='key.txt')
     parser.add_argument('--save_dir', type=str, default='results/')
     parser.add_argument('--plan_generation_result_file', type=str, default='default_pg.json')
     parser.add_argument('--processed_plan_generation_result_file', type=str, default=None)
     parser.add_argument('--graph_dict_path', type=str)
     parser.add_argument('--plan_generation_prompt_path', type=str)
+    parser.add_argument('--cache_path', type=str, default=None)     # sqlite file caching api responses, disabled if None
+    parser.add_argument('--env_prompt_cache', type=str, default=None)   # json lines file keeping the scene prompts of plan generation across runs, memory only if None
+    parser.add_argument('--cache_max_mb', type=float, default=1024)
 
 
     # Multiprocess options
     parser.add_argument('--n_processes', type=int, default=1)
+    parser.add_argument('--max_in_flight', type=int, default=1)    # api requests awaited concurrently inside one process
 
     parser.add_argument('--seed', type=int, default=42)
 
+    # Api key pool (shared by all processes) and retries
+    parser.add_argument('--key_rpm', type=int, default=0)  # requests per minute of each key, 0 for no limit
+    parser.add_argument('--key_tpm', type=int, default=0)  # tokens per minute of each key, 0 for no limit
+    parser.add_argument('--max_retries', type=int, default=10)
+    parser.add_argument('--hedge_percentile', type=float, default=0)    # send a duplicate request on another key once a request is slower than this latency percentile of its engine, 0 disables hedging, the counts and extra tokens are saved to <result file>_hedging.json
+    parser.add_argument('--hedge_window', type=int, default=200)    # number of recent requests the percentile is computed over
+    parser.add_argument('--hedge_min_samples', type=int, default=20)   # no hedging before this many requests of the engine
+    parser.add_argument('--request_deadline', type=float, default=600)    # seconds before a request is given up
+
+    # Backend, 'mock' answers offline for benchmarks, 'local' runs a causal LM on CPU (see generation/backends.py)
+    parser.add_argument('--backend', type=str, default='openai', choices=['openai', 'mock', 'local'])
+    parser.add_argument('--mock_dataset', type=str, default=None)  # plans are drawn from it, retrieval_dataset if None
+    parser.add_argument('--mock_latency', type=str, default='const:0',
+                        help='const:m, uniform:low:high, normal:mean:std or lognormal:median:sigma (seconds)')
+    parser.add_argument('--mock_error_rate', type=float, default=0.0)
+    parser.add_argument('--mock_error_types', type=str, default='RateLimitError,ServiceUnavailableError')
+    parser.add_argument('--mock_choice_peak', type=float, default=0.6)    # probability mass on the first choice
+    parser.add_argument('--mock_plans_per_prompt', type=int, default=8)
+    parser.add_argument('--local_model_path', type=str, default=None)  # utils/gpt2 if None (weights not bundled)
+    parser.add_argument('--local_prefix_cache_size', type=int, default=4)  # prompts whose key / value states are kept
+    parser.add_argument('--local_threads', type=int, default=0)    # torch cpu threads, 0 for the torch default
+
     # Codex options
     parser.add_argument('--engine', type=str, default="text-davinci-003")
-    parser.add_argument('--n_parallel_prompts', type=int, default=1)    # this is an parameter of openai api. we assert this to 1 during our experiment.
+    parser.add_argument('--n_parallel_prompts', type=int, default=1)    # number of task prompts batched in one completion request (plan generation)
+    parser.add_argument('--max_n_per_request', type=int, default=0)  # largest n of one api request (chat models cap it lower), 0 for 1000
+    parser.add_argument('--fan_out', type=int, default=1)  # split the samples of a prompt into this many concurrent requests, 0 for one per api key
+    parser.add_argument('--stream', action='store_true')    # stream plan samples and cut the ones with unknown actions or repeating a completed plan early (plan generation)
     parser.add_argument('--max_generation_tokens', type=int, default=512)
     parser.add_argument('--max_api_total_tokens', type=int, default=4096)
     parser.add_argument('--temperature', type=float, default=0.4)
     parser.add_argument('--sampling_n', type=int, default=20)
+    parser.add_argument('--min_sampling_n', type=int, default=0)    # plan generation samples in rounds when > 0: min_sampling_n first, then sampling_round_n per round up to sampling_n (local backend only, see README)
+    parser.add_argument('--sampling_round_n', type=int, default=10)
+    parser.add_argument('--saturation_threshold', type=int, default=1)  # stop sampling a task once a round adds fewer new distinct plans / tree nodes
+    parser.add_argument('--saturation_measure', type=str, default='plans', choices=['plans', 'nodes'])
+    parser.add_argument('--max_tokens_per_new_plan', type=int, default=0)  # also stop sampling a task once a round spent more prompt + completion tokens per new distinct plan / tree node, 0 for no limit
+    parser.add_argument('--choice_scoring', type=str, default='vote', choices=['vote', 'logprob'])  # grounded deciding: majority vote of samples, or top logprobs of the answer letter in a single sample
+    parser.add_argument('--top_logprobs', type=int, default=5)  # top logprobs per token requested for logprob choice scoring (at most 5 for openai completions)
+    parser.add_argument('--requery_policy', type=str, default='always', choices=['always', 'fallback'])  # after a failed action, ask the llm again or take the next best valid choice of the previous decision at that node
+    parser.add_argument('--requery_threshold', type=float, default=0.0)    # fallback only if that choice holds at least this probability among the valid choices, else ask again
+    parser.add_argument('--vote_batch_size', type=int, default=0)   # grounded deciding draws the sampling_n votes in batches of this size and stops once the vote is decided, 0 draws them at once (local backend only, see README)
+    parser.add_argument('--vote_confidence', type=float, default=1.0)   # also stop once the leading choice holds this share of the votes (1.0: only when the remaining votes cannot change the winner)
+    parser.add_argument('--observation_format', type=str, default='full', choices=['full', 'compact'])   # grounded deciding observation: every fact line, or deduplicated facts grouped by relation and ranked by relevance to the choices and the task
+    parser.add_argument('--max_observation_tokens', type=int, default=0)    # token budget of the compact observation facts (local tokenizer), 0 for no limit
     parser.add_argument('--top_p', type=float, default=1.0)
     parser.add_argument('--stop_tokens', type=str, default='\n\n',    # @mengkang for plan generation
                         help='Split stop tokens by ||')
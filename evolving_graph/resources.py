@@ -0,0 +1,35 @@
+# Simulator resources parsed once per process and shared read-only by all executors, helpers and states
+import threading
+from .utils import load_name_equivalence, load_properties_data, load_object_placing, load_object_states
+
+
+LOADERS = {
+    'name_equivalence': load_name_equivalence,
+    'properties_data': load_properties_data,
+    'object_placing': load_object_placing,
+    'object_states': load_object_states,
+}
+_resources = {}
+_lock = threading.Lock()
+
+
+def get_resource(name):
+    """
+    The resource name (a key of LOADERS), loaded on first use. It is shared, callers must not modify it.
+    """
+    resource = _resources.get(name, None)
+    if resource is None:
+        with _lock:
+            if name not in _resources:
+                _resources[name] = LOADERS[name]()
+            resource = _resources[name]
+    return resource
+
+
+def preload_resources():
+    """
+    Load every resource, the initializer of the worker pools.
+    Called in the parent before the pool is created, forked workers inherit the parsed resources and load nothing.
+    """
+    for name in LOADERS:
+        get_resource(name)
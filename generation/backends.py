@@ -0,0 +1,326 @@
+# Backends answering the requests built by Generator
+import os
+import re
+import json
+import math
+import time
+import random
+import asyncio
+import hashlib
+
+
+class Backend(object):
+    """
+    Interface of a generation backend. The four methods take the keyword arguments of
+    openai.Completion.create / openai.ChatCompletion.create and return a result of the same shape:
+    {'choices': [...], 'usage': {'prompt_tokens', 'completion_tokens', 'total_tokens'}}.
+    name and model_id() are part of the response cache key, so that backends never answer from each other's entries.
+    reuses_prompt_prefix tells whether a prompt sent again costs only its new tokens (see README).
+    """
+    requires_key = True
+    name = 'openai'
+    reuses_prompt_prefix = False
+
+    def model_id(self):
+        """
+        What the backend answers with besides the requested engine, '' when the engine says it all.
+        """
+        return ''
+
+    def completion(self, **kwargs):
+        raise NotImplementedError
+
+    async def acompletion(self, **kwargs):
+        raise NotImplementedError
+
+    def chat(self, **kwargs):
+        raise NotImplementedError
+
+    async def achat(self, **kwargs):
+        raise NotImplementedError
+
+    def stream_completion(self, on_delta, **kwargs):
+        """
+        Streaming version of completion. on_delta(index, text so far, finished) is called whenever a choice
+        grows and returns True to cut that choice, cut choices get the finish_reason 'cut'.
+        By default the full completion is replayed line by line, backends able to stream override it.
+        """
+        return self._replay(self.completion(**kwargs), on_delta, chat=False)
+
+    def stream_chat(self, on_delta, **kwargs):
+        return self._replay(self.chat(**kwargs), on_delta, chat=True)
+
+    def _replay(self, result, on_delta, chat):
+        collector = StreamCollector(on_delta, len(result['choices']), chat=chat)
+        for c in result['choices']:
+            text = c['message']['content'] if chat else c['text']
+            lines = text.split('\n')
+            for idx, line in enumerate(lines):
+                collector.add(c['index'], line if idx == len(lines) - 1 else line + '\n')
+                if collector.is_finished(c['index']):
+                    break
+            # as in real streams, the finish reason comes with a last empty delta
+            collector.add(c['index'], '', c.get('finish_reason', None) or 'stop')
+        return collector.result(completion_tokens=result['usage']['completion_tokens'], prompt_tokens=result['usage']['prompt_tokens'])
+
+
+class StreamCollector(object):
+    """
+    Accumulates streamed deltas of the choices of one request and builds a non-streaming result.
+    """
+
+    def __init__(self, on_delta, n_choices, chat=False):
+        self.on_delta = on_delta
+        self.n_choices = n_choices
+        self.chat = chat
+        self.texts = {}
+        self.n_tokens = {}
+        self.finish_reason = {}
+
+    def add(self, index, delta, finish_reason=None):
+        if index in self.finish_reason:
+            return
+        self.texts[index] = self.texts.get(index, '') + delta
+        self.n_tokens[index] = self.n_tokens.get(index, 0) + 1
+        if self.on_delta(index, self.texts[index], finish_reason is not None):
+            self.finish_reason[index] = 'cut'
+        elif finish_reason is not None:
+            self.finish_reason[index] = finish_reason
+
+    def is_finished(self, index):
+        return index in self.finish_reason
+
+    def done(self):
+        return len(self.finish_reason) == self.n_choices
+
+    def result(self, completion_tokens=None, prompt_tokens=None):
+        # prompt tokens are not reported by streams, None is filled by the caller
+        choices = []
+        for index in range(self.n_choices):
+            text = self.texts.get(index, '')
+            c = {'message': {'role': 'assistant', 'content': text}} if self.chat else {'text': text, 'logprobs': None}
+            c.update({'index': index, 'finish_reason': self.finish_reason.get(index, 'cut')})
+            choices.append(c)
+        if completion_tokens is None:
+            completion_tokens = sum(self.n_tokens.values())
+        return {'choices': choices, 'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                                              'total_tokens': None if prompt_tokens is None else prompt_tokens + completion_tokens}}
+
+
+class OpenAIBackend(Backend):
+    def completion(self, **kwargs):
+        import openai
+        return openai.Completion.create(**kwargs)
+
+    async def acompletion(self, **kwargs):
+        import openai
+        return await openai.Completion.acreate(**kwargs)
+
+    def chat(self, **kwargs):
+        import openai
+        return openai.ChatCompletion.create(**kwargs)
+
+    async def achat(self, **kwargs):
+        import openai
+        return await openai.ChatCompletion.acreate(**kwargs)
+
+    def stream_completion(self, on_delta, **kwargs):
+        import openai
+        prompt = kwargs['prompt']
+        kwargs.pop('logprobs', None)
+        collector = StreamCollector(on_delta, kwargs['n'] * (len(prompt) if isinstance(prompt, list) else 1))
+        for chunk in openai.Completion.create(stream=True, **kwargs):
+            for c in chunk['choices']:
+                collector.add(c['index'], c['text'], c.get('finish_reason', None))
+            if collector.done():    # every choice is complete or cut, stop reading
+                break
+        return collector.result()
+
+    def stream_chat(self, on_delta, **kwargs):
+        import openai
+        collector = StreamCollector(on_delta, kwargs['n'], chat=True)
+        for chunk in openai.ChatCompletion.create(stream=True, **kwargs):
+            for c in chunk['choices']:
+                collector.add(c['index'], c['delta'].get('content', ''), c.get('finish_reason', None))
+            if collector.done():
+                break
+        return collector.result()
+
+
+# errors raised by MockBackend, named after the openai errors so that the key pool treats them the same way
+class RateLimitError(Exception):
+    pass
+
+
+class ServiceUnavailableError(Exception):
+    pass
+
+
+class Timeout(Exception):
+    pass
+
+
+MOCK_ERRORS = {e.__name__: e for e in [RateLimitError, ServiceUnavailableError, Timeout]}
+
+
+def parse_latency(spec):
+    """
+    Latency distribution in seconds, one of
+    'const:m', 'uniform:low:high', 'normal:mean:std', 'lognormal:median:sigma'
+    """
+    name, *params = spec.split(':')
+    params = [float(_) for _ in params]
+    if name == 'const':
+        return lambda rng: params[0]
+    if name == 'uniform':
+        return lambda rng: rng.uniform(params[0], params[1])
+    if name == 'normal':
+        return lambda rng: max(0.0, rng.gauss(params[0], params[1]))
+    if name == 'lognormal':
+        return lambda rng: params[0] * math.exp(rng.gauss(0, params[1]))
+    raise ValueError(f'Unknown latency distribution {spec}')
+
+
+CHOICE_PATTERN = re.compile(r'^([A-Z]+)\. ', re.M)
+
+
+class MockBackend(Backend):
+    """
+    Offline stand-in of the openai api for benchmarks and load tests.
+    Plan generation prompts are answered with programs drawn from a dataset (a few candidate programs per
+    prompt, sampled with a zipf skew so that duplicated plans show up as with a real model).
+    Grounded deciding prompts are answered with a choice label, the first listed choice gets choice_peak
+    of the probability mass and the rest is uniform.
+    Latency follows the given distribution and error_rate of the requests raise one of error_types.
+    """
+    requires_key = False
+    name = 'mock'
+
+    def __init__(self, dataset_path, latency='const:0', error_rate=0.0, error_types='RateLimitError,ServiceUnavailableError',
+                 choice_peak=0.6, plans_per_prompt=8, zipf_s=1.2, seed=42):
+        self.dataset_path = dataset_path
+        self.latency_spec = latency
+        self.latency = parse_latency(latency)
+        self.error_rate = error_rate
+        self.error_types = [MOCK_ERRORS[_] for _ in error_types.split(',') if _ != '']
+        self.choice_peak = choice_peak
+        self.plans_per_prompt = plans_per_prompt
+        self.zipf_s = zipf_s
+        self.rng = random.Random(seed)
+        self._programs = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.update({'latency': None, '_programs': None})
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.latency = parse_latency(self.latency_spec)
+
+    def model_id(self):
+        return f'{os.path.realpath(self.dataset_path)}:{self.choice_peak}:{self.plans_per_prompt}:{self.zipf_s}'
+
+    def _get_programs(self):
+        if self._programs is None:
+            self._programs = [_['program'] for _ in json.load(open(self.dataset_path, 'r', encoding='utf')) if len(_.get('program', [])) > 0]
+        return self._programs
+
+    def _maybe_fail(self):
+        if len(self.error_types) > 0 and self.rng.random() < self.error_rate:
+            raise self.rng.choice(self.error_types)('Injected error by MockBackend')
+
+    def _answer(self, prompt, n, stop):
+        choices = CHOICE_PATTERN.findall(prompt.split('Among the following')[-1]) if 'Among the following' in prompt else []
+        texts = []
+        if len(choices) > 0:    # grounded deciding
+            for _ in range(n):
+                c = choices[0] if self.rng.random() < self.choice_peak else self.rng.choice(choices)
+                texts.append(c)
+        else:   # plan generation
+            programs = self._get_programs()
+            # candidate plans only depend on the prompt, so reruns of a task see the same plan set
+            prompt_rng = random.Random(int(hashlib.md5(prompt.encode('utf')).hexdigest(), 16))
+            candidates = [prompt_rng.choice(programs) for _ in range(self.plans_per_prompt)]
+            weights = [1 / (i + 1) ** self.zipf_s for i in range(len(candidates))]
+            for _ in range(n):
+                texts.append('\n'.join(self.rng.choices(candidates, weights=weights)[0]))
+        for s in stop or []:
+            texts = [t.split(s)[0] for t in texts]
+        return texts, choices
+
+    def _usage(self, prompts, texts):
+        prompt_tokens = sum([len(p) // 4 for p in prompts])
+        completion_tokens = sum([len(t.split(' ')) for t in texts])
+        return {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens, 'total_tokens': prompt_tokens + completion_tokens}
+
+    def _logprobs(self, text, choices):
+        tokens = text.split(' ')
+        top = {}
+        if len(choices) > 0:
+            rest = (1 - self.choice_peak) / len(choices)
+            top = {c: math.log(rest + (self.choice_peak if idx == 0 else 0)) for idx, c in enumerate(choices)}
+        return {
+            'tokens': tokens,
+            'token_logprobs': [top.get(tokens[0], -1.0)] + [-1.0] * (len(tokens) - 1),
+            'top_logprobs': [top if len(top) > 0 else {tokens[0]: -1.0}] + [{t: -1.0} for t in tokens[1:]],
+        }
+
+    def _completion(self, prompt, n, stop, **kwargs):
+        self._maybe_fail()
+        prompts = prompt if isinstance(prompt, list) else [prompt]
+        result_choices, all_texts = [], []
+        for p_idx, p in enumerate(prompts):
+            texts, choices = self._answer(p, n, stop)
+            all_texts += texts
+            for idx, t in enumerate(texts):
+                result_choices.append({'text': t, 'index': p_idx * n + idx, 'logprobs': self._logprobs(t, choices), 'finish_reason': 'stop'})
+        return {'choices': result_choices, 'usage': self._usage(prompts, all_texts)}
+
+    def _chat(self, messages, n, stop, **kwargs):
+        self._maybe_fail()
+        prompt = '\n'.join([m['content'] for m in messages])
+        texts, _ = self._answer(prompt, n, stop)
+        result_choices = [{'message': {'role': 'assistant', 'content': t}, 'index': idx, 'finish_reason': 'stop'} for idx, t in enumerate(texts)]
+        return {'choices': result_choices, 'usage': self._usage([prompt], texts)}
+
+    def completion(self, **kwargs):
+        time.sleep(self.latency(self.rng))
+        return self._completion(**kwargs)
+
+    async def acompletion(self, **kwargs):
+        await asyncio.sleep(self.latency(self.rng))
+        return self._completion(**kwargs)
+
+    def chat(self, **kwargs):
+        time.sleep(self.latency(self.rng))
+        return self._chat(**kwargs)
+
+    async def achat(self, **kwargs):
+        await asyncio.sleep(self.latency(self.rng))
+        return self._chat(**kwargs)
+
+
+def get_backend(args):
+    backend = getattr(args, 'backend', 'openai')
+    if backend == 'openai':
+        return OpenAIBackend()
+    if backend == 'mock':
+        return MockBackend(
+            dataset_path=args.mock_dataset if args.mock_dataset is not None else args.retrieval_dataset,
+            latency=args.mock_latency,
+            error_rate=args.mock_error_rate,
+            error_types=args.mock_error_types,
+            choice_peak=args.mock_choice_peak,
+            plans_per_prompt=args.mock_plans_per_prompt,
+            seed=args.seed
+        )
+    if backend == 'local':
+        from generation.local_backend import LocalHFBackend
+        return LocalHFBackend(
+            model_path=args.local_model_path,
+            prefix_cache_size=args.local_prefix_cache_size,
+            n_threads=args.local_threads,
+            seed=args.seed
+        )
+    raise ValueError(f'Unknown backend {backend}')
@@ -0,0 +1,243 @@
+# On-disk cache of raw api responses
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import asyncio
+import threading
+from typing import List, Union
+
+
+def _pid_alive(pid):
+    if os.name == 'nt':     # os.kill would terminate the process, stale claims are only detected by their age
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class ResponseCache(object):
+    """
+    Content-addressed response cache backed by sqlite, shared by all processes using the same path.
+    The key is a hash of the backend (and its model), the engine, the prompt text and the sampling parameters.
+    The least recently used entries are evicted once the stored responses exceed max_size_mb.
+    Identical requests issued at the same time are collapsed into a single api call: across the threads / coroutines
+    of a process through in-flight events and futures, and across processes through a claim row of the key in the
+    inflight table. Other processes poll for the response while the claim holds, a claim whose process died or that
+    is older than claim_timeout seconds is taken over.
+    """
+
+    def __init__(self, path, max_size_mb=1024, claim_timeout=600, poll_interval=0.5, verbose=False):
+        self.path = path
+        self.max_size = int(max_size_mb * 1024 * 1024)
+        self.claim_timeout = claim_timeout
+        self.poll_interval = poll_interval
+        self.verbose = verbose
+        self._conn = None
+        self._conn_pid = None
+        self._lock = threading.Lock()
+        self._inflight = {}     # key -> threading.Event (sync callers)
+        self._ainflight = {}    # key -> asyncio.Future (coroutine callers)
+        if os.path.dirname(path) != '':
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    def __getstate__(self):
+        # connections, locks and futures are per process
+        return {'path': self.path, 'max_size': self.max_size, 'claim_timeout': self.claim_timeout,
+                'poll_interval': self.poll_interval, 'verbose': self.verbose}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._conn, self._conn_pid = None, None
+        self._lock = threading.Lock()
+        self._inflight, self._ainflight = {}, {}
+
+    @staticmethod
+    def make_key(
+            engine: str,
+            prompt: Union[str, List],
+            max_tokens,
+            temperature: float,
+            top_p: float,
+            n: int,
+            stop: List[str],
+            logprobs: int = 1,
+            sample_offset: int = 0,
+            backend: str = 'openai',
+            model_id: str = ''
+    ):
+        request = {
+            'engine': engine,
+            'prompt': prompt,
+            'max_tokens': max_tokens,
+            'temperature': temperature,
+            'top_p': top_p,
+            'n': n,
+            'stop': stop
+        }
+        if logprobs != 1:
+            request['logprobs'] = logprobs
+        if sample_offset > 0:   # later samples of a prompt drawn in several requests, keys of single requests are unchanged
+            request['sample_offset'] = sample_offset
+        if backend != 'openai':     # the mock and local backends answer the same engine name differently
+            request['backend'] = backend
+        if model_id != '':  # e.g. the model path of the local backend
+            request['model_id'] = model_id
+        content = json.dumps(request, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(content.encode('utf')).hexdigest()
+
+    def _get_conn(self):
+        # sqlite connections must not be shared across fork
+        if self._conn is None or self._conn_pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT, size INTEGER, last_access REAL)')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS inflight (key TEXT PRIMARY KEY, pid INTEGER, started REAL)')
+            self._conn.commit()
+            self._conn_pid = os.getpid()
+        return self._conn
+
+    def get(self, key):
+        with self._lock:
+            conn = self._get_conn()
+            row = conn.execute('SELECT value FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            conn.execute('UPDATE responses SET last_access = ? WHERE key = ?', (time.time(), key))
+            conn.commit()
+        return json.loads(row[0])
+
+    def put(self, key, value):
+        value = json.dumps(value, ensure_ascii=False)
+        with self._lock:
+            conn = self._get_conn()
+            conn.execute('INSERT OR REPLACE INTO responses (key, value, size, last_access) VALUES (?, ?, ?, ?)',
+                         (key, value, len(value), time.time()))
+            conn.commit()
+            self._evict(conn)
+
+    def _evict(self, conn):
+        total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        if total <= self.max_size:
+            return
+        to_delete = []
+        for key, size in conn.execute('SELECT key, size FROM responses ORDER BY last_access ASC'):
+            if total <= self.max_size:
+                break
+            to_delete.append((key,))
+            total -= size
+        conn.executemany('DELETE FROM responses WHERE key = ?', to_delete)
+        conn.commit()
+
+    def _claim(self, key):
+        """
+        Claim key for this process, False while a live claim of another process holds it.
+        """
+        with self._lock:
+            conn = self._get_conn()
+            conn.execute('BEGIN IMMEDIATE')     # the check and the claim are one write transaction
+            try:
+                row = conn.execute('SELECT pid, started FROM inflight WHERE key = ?', (key,)).fetchone()
+                if row is not None and row[0] != os.getpid() and time.time() - row[1] < self.claim_timeout and _pid_alive(row[0]):
+                    return False
+                conn.execute('INSERT OR REPLACE INTO inflight (key, pid, started) VALUES (?, ?, ?)', (key, os.getpid(), time.time()))
+                return True
+            finally:
+                conn.commit()
+
+    def _release(self, key):
+        with self._lock:
+            conn = self._get_conn()
+            conn.execute('DELETE FROM inflight WHERE key = ? AND pid = ?', (key, os.getpid()))
+            conn.commit()
+
+    def _cache_hit(self, key):
+        result = self.get(key)
+        if result is not None and self.verbose:
+            print(f'Cache hit: {key[:12]}')
+        return result
+
+    def get_or_compute(self, key, fn):
+        """
+        Return the cached response of key, or call fn() once and cache its result.
+        Threads asking for the same key while fn() runs wait for that call instead of issuing their own,
+        so do other processes using the same path.
+        """
+        while True:
+            result = self._cache_hit(key)
+            if result is not None:
+                return result
+            with self._lock:
+                event = self._inflight.get(key, None)
+                owner = event is None
+                if owner:
+                    event = threading.Event()
+                    self._inflight[key] = event
+            if not owner:
+                event.wait()
+                continue    # the owner stored the result (or failed, then we try ourselves)
+            try:
+                while not self._claim(key):     # another process calls the api, wait for its response
+                    time.sleep(self.poll_interval)
+                    result = self._cache_hit(key)
+                    if result is not None:
+                        return result
+                try:
+                    result = fn()
+                    self.put(key, result)
+                    return result
+                finally:
+                    self._release(key)
+            finally:
+                with self._lock:
+                    self._inflight.pop(key, None)
+                event.set()
+
+    async def aget_or_compute(self, key, coro_fn):
+        """
+        Coroutine version of get_or_compute, coro_fn() returns an awaitable.
+        """
+        while True:
+            result = self._cache_hit(key)
+            if result is not None:
+                return result
+            future = self._ainflight.get(key, None)
+            if future is not None:
+                try:
+                    return await asyncio.shield(future)
+                except Exception:
+                    continue    # the owner failed, try ourselves
+                except asyncio.CancelledError:
+                    if future.cancelled():
+                        continue
+                    raise
+            future = asyncio.get_running_loop().create_future()
+            self._ainflight[key] = future
+            try:
+                while not self._claim(key):     # another process calls the api, wait for its response
+                    await asyncio.sleep(self.poll_interval)
+                    result = self._cache_hit(key)
+                    if result is not None:
+                        future.set_result(result)
+                        return result
+                try:
+                    result = await coro_fn()
+                    self.put(key, result)
+                finally:
+                    self._release(key)
+                future.set_result(result)
+                return result
+            except asyncio.CancelledError:
+                future.cancel()
+                raise
+            except Exception as e:
+                future.set_exception(e)
+                future.exception()  # mark as retrieved when nobody else is waiting
+                raise
+            finally:
+                self._ainflight.pop(key, None)
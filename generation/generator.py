@@ -1,9 +1,16 @@
 # Wrapped OpenAI Generator
 import json
 from typing import Dict, List, Union, Tuple
-import openai
 import time
 import random
+import asyncio
+import functools
+import threading
+import concurrent.futures
+from generation.cache import ResponseCache
+from generation.hedging import LatencyTracker
+from generation.key_pool import KeyPool, RequestFailed
+from generation.backends import get_backend
 # from generation.prompt import PromptBuilder
 
 
@@ -12,51 +19,198 @@ class Generator(object):
     Codex generation wrapper.
     """
 
-    def __init__(self, args, keys=None, tokenizer=None):
+    def __init__(self, args, keys=None, tokenizer=None, backend=None):
         self.args = args
-        self.keys = keys
-        self.current_key_id = 0
+        # the backend answers the requests, openai by default (see generation/backends.py)
+        self.backend = backend if backend is not None else get_backend(args)
+        # keys can be a plain list (private pool) or a KeyPool shared by all worker processes
+        self.key_pool = keys if isinstance(keys, KeyPool) else KeyPool(keys if keys is not None else [])
+        if len(self.key_pool) == 0 and not self.backend.requires_key:
+            self.key_pool = KeyPool(['local'])
+        self.keys = self.key_pool.keys
+        self.max_retries = getattr(args, 'max_retries', 10)
+        self.request_deadline = getattr(args, 'request_deadline', 600)
         self.tokenizer = tokenizer
+        # number of api requests allowed in flight at the same time (per process)
+        self.max_in_flight = max(1, getattr(args, 'max_in_flight', 1))
+        # asyncio objects are bound to a running loop, they are created lazily inside the worker process
+        self._semaphore = None
+        self._semaphore_loop = None
+        self._loop = None
+        self._loop_thread = None
+        # persistent response cache, disabled when no path is given
+        cache_path = getattr(args, 'cache_path', None)
+        self.cache = ResponseCache(
+            cache_path,
+            max_size_mb=getattr(args, 'cache_max_mb', 1024),
+            claim_timeout=getattr(args, 'request_deadline', 600),
+            verbose=getattr(args, 'verbose', False)
+        ) if cache_path else None
+        # request hedging: once a request is slower than the hedge_percentile latency of its engine,
+        # the same request is sent on another key and the first answer wins (0 disables hedging)
+        self.hedge_percentile = getattr(args, 'hedge_percentile', 0)
+        self.latency_trackers = {}
+        # tokens of the losing requests are not part of the returned usage, they are counted here
+        # (from the request threads and the loser callbacks, under _hedge_lock), see hedge_summary()
+        self.hedge_stats = {'hedged': 0, 'won': 0, 'extra_tokens': 0}
+        self._hedge_lock = threading.Lock()
+        self._hedge_executor = None
 
         # if the args provided, will initialize with the prompt builder for full usage
         # self.prompt_builder = PromptBuilder(args) if args else None
 
+    def __getstate__(self):
+        # the generator is sent to pool workers, loops / threads / semaphores can not be pickled
+        state = self.__dict__.copy()
+        state.update({'_semaphore': None, '_semaphore_loop': None, '_loop': None, '_loop_thread': None, '_hedge_executor': None, '_hedge_lock': None})
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._hedge_lock = threading.Lock()
+
+    def _prepare_prompts(self, prompts: List[Tuple], n: int):
+        result_idx_to_eid = []
+        # several prompts are sent in one request, result_idx_to_eid maps every choice back to its eid
+        for p in prompts:
+            result_idx_to_eid.extend([p[0]] * n)
+        prompts = [p[1] for p in prompts]
+        return result_idx_to_eid, prompts
+
+    def _request_kwargs(self, prompts, n, logprobs=1):
+        kwargs = dict(
+            engine=self.args.engine,
+            prompt=prompts,
+            max_tokens=self.args.max_generation_tokens,
+            temperature=self.args.temperature,
+            top_p=self.args.top_p,
+            n=n,
+            stop=self.args.stop_tokens
+        )
+        if logprobs != 1:   # number of top logprobs returned per token (completion engines)
+            kwargs['logprobs'] = logprobs
+        return kwargs
+
+    def _cache_key(self, sample_offset, kwargs):
+        return ResponseCache.make_key(sample_offset=sample_offset, backend=self.backend.name, model_id=self.backend.model_id(), **kwargs)
+
+    def _is_completion_engine(self, engine):
+        completion_list = ['text-davinci-003']
+        return engine in completion_list
 
     def generate_one_pass(
             self,
             prompts: List[Tuple],
-            verbose: bool = False
+            verbose: bool = False,
+            stream_checkers: List = None,
+            n: int = None,
+            sample_offset: int = 0,
+            logprobs: int = 1
     ):
         """
         Generate one pass with codex according to the generation phase.
+        With stream_checkers (one per prompt, see _call_stream_api) the samples are streamed and checked on the fly.
+        n overrides args.sampling_n. When the samples of a prompt are drawn in several calls, sample_offset is
+        the number of samples drawn before, so that every call gets its own cache entry.
+        logprobs is the number of top logprobs returned for every token by completion engines.
         """
-        result_idx_to_eid = []
-        assert len(prompts) == 1  # @mengkang assume only one prompt
-        for p in prompts:
-            result_idx_to_eid.extend([p[0]] * self.args.sampling_n)
-        prompts = [p[1] for p in prompts]
-        engine = self.args.engine
-        completion_list = ['text-davinci-003']
-        if engine in completion_list:
-            result = self._call_codex_api(
-                engine=self.args.engine,
-                prompt=prompts,
-                max_tokens=self.args.max_generation_tokens,
-                temperature=self.args.temperature,
-                top_p=self.args.top_p,
-                n=self.args.sampling_n,
-                stop=self.args.stop_tokens
-            )
+        if self._loop is not None and threading.current_thread() is not self._loop_thread:
+            # called from a worker thread while the background loop is running, share its in-flight budget
+            return asyncio.run_coroutine_threadsafe(self.agenerate_one_pass(prompts, verbose, stream_checkers, n, sample_offset, logprobs), self._loop).result()
+        result_idx_to_eid, prompts = self._prepare_prompts(prompts, n or self.args.sampling_n)
+        result = self._call_api(prompts, stream_checkers, n or self.args.sampling_n, sample_offset, logprobs)
+        return self._parse_result(result, result_idx_to_eid, prompts, verbose)
+
+    async def agenerate_one_pass(
+            self,
+            prompts: List[Tuple],
+            verbose: bool = False,
+            stream_checkers: List = None,
+            n: int = None,
+            sample_offset: int = 0,
+            logprobs: int = 1
+    ):
+        """
+        Coroutine version of generate_one_pass. At most max_in_flight requests are awaited at the same time.
+        """
+        result_idx_to_eid, prompts = self._prepare_prompts(prompts, n or self.args.sampling_n)
+        result = await self._acall_api(prompts, stream_checkers, n or self.args.sampling_n, sample_offset, logprobs)
+        return self._parse_result(result, result_idx_to_eid, prompts, verbose)
+
+    def generate_many(
+            self,
+            prompts_list: List[List[Tuple]],
+            verbose: bool = False,
+            stream_checkers_list: List[List] = None,
+            n: int = None,
+            sample_offset: int = 0
+    ):
+        """
+        Run generate_one_pass for every element of prompts_list concurrently, results keep the input order.
+        """
+        if stream_checkers_list is None:
+            stream_checkers_list = [None] * len(prompts_list)
+
+        async def _gather():
+            return await asyncio.gather(*[self.agenerate_one_pass(p, verbose, c, n, sample_offset) for p, c in zip(prompts_list, stream_checkers_list)], return_exceptions=True)
+        if self._loop is not None:
+            return asyncio.run_coroutine_threadsafe(_gather(), self._loop).result()
+        return asyncio.run(_gather())
+
+    def _call_api(self, prompts, stream_checkers=None, n=None, sample_offset=0, logprobs=1):
+        kwargs = self._request_kwargs(prompts, n or self.args.sampling_n, logprobs)
+        if stream_checkers is not None:
+            call = functools.partial(self._call_stream_api, stream_checkers)
         else:
-            result = self._call_chat_api(
-                engine=self.args.engine,
-                prompt=prompts,
-                max_tokens=self.args.max_generation_tokens,
-                temperature=self.args.temperature,
-                top_p=self.args.top_p,
-                n=self.args.sampling_n,
-                stop=self.args.stop_tokens
-            )
+            call = self._call_codex_api if self._is_completion_engine(self.args.engine) else self._call_chat_api
+        if self.cache is None:
+            return call(**kwargs)
+        return self.cache.get_or_compute(self._cache_key(sample_offset, kwargs), lambda: call(**kwargs))
+
+    async def _acall_api(self, prompts, stream_checkers=None, n=None, sample_offset=0, logprobs=1):
+        kwargs = self._request_kwargs(prompts, n or self.args.sampling_n, logprobs)
+        call = self._acall_codex_api if self._is_completion_engine(self.args.engine) else self._acall_chat_api
+
+        async def _limited_call():
+            async with self._get_semaphore():
+                if stream_checkers is not None:
+                    # streams are consumed synchronously (checkers run on every delta), keep them off the loop
+                    return await asyncio.get_running_loop().run_in_executor(None, functools.partial(self._call_stream_api, stream_checkers, **kwargs))
+                return await call(**kwargs)
+        if self.cache is None:
+            return await _limited_call()
+        # cache lookups and waiting on an identical in-flight request do not take a slot
+        return await self.cache.aget_or_compute(self._cache_key(sample_offset, kwargs), _limited_call)
+
+    def _get_semaphore(self):
+        loop = asyncio.get_running_loop()
+        if self._semaphore is None or self._semaphore_loop is not loop:
+            self._semaphore = asyncio.Semaphore(self.max_in_flight)
+            self._semaphore_loop = loop
+        return self._semaphore
+
+    def start_background_loop(self):
+        """
+        Start an event loop in a daemon thread. While it runs, generate_one_pass called from other threads
+        is scheduled on this loop, so synchronous callers (e.g. grounded_exec in a thread pool) share max_in_flight.
+        """
+        if self._loop is not None:
+            return
+        self._loop = asyncio.new_event_loop()
+        self._loop_thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._loop_thread.start()
+
+    def stop_background_loop(self):
+        if self._loop is None:
+            return
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._loop_thread.join()
+        self._loop.close()
+        self._loop, self._loop_thread = None, None
+
+    def _parse_result(self, result, result_idx_to_eid, prompts, verbose):
+        engine = self.args.engine
+        completion = self._is_completion_engine(engine)
         if verbose:
             print('\n', '*' * 20, 'Codex API Call', '*' * 20)
             for prompt in prompts:
@@ -66,10 +220,14 @@ class Generator(object):
 
         # parse api results
         response_dict = dict()
-        usage = result['usage']
+        usage = dict(result['usage'])
+        # usage of each eid, the aggregated numbers above are kept for single prompt callers
+        usage['per_eid'] = self._split_usage(result, prompts, result_idx_to_eid)
         for idx, g in enumerate(result['choices']):
+            if g.get('finish_reason', None) == 'invalid':   # dropped while streaming
+                continue
             try:
-                text = g['text'] if engine in completion_list else g['message']['content']
+                text = g['text'] if completion else g['message']['content']
                 # text = g['text']
                 # logprob = sum(g['logprobs']['token_logprobs'])
                 eid = result_idx_to_eid[idx]
@@ -78,7 +236,7 @@ class Generator(object):
                     eid_pairs = []
                     response_dict[eid] = eid_pairs
                 # eid_pairs.append((text, logprob))
-                eid_pairs.append((text, g['logprobs'] if engine in completion_list else 0))
+                eid_pairs.append((text, g['logprobs'] if completion else 0))
 
                 if verbose:
                     print(text)
@@ -93,51 +251,422 @@ class Generator(object):
 
         return response_dict, usage
 
-    def _call_codex_api(
+    def _merge_chunks(self, chunks, n_prompts):
+        """
+        Merge the responses of several requests, given as (prompt offset, n, response) tuples.
+        Choices are ordered prompt by prompt (all samples of the first prompt come first), which is the
+        order result_idx_to_eid expects, and usage is summed over the requests.
+        """
+        per_prompt = [[] for _ in range(n_prompts)]
+        per_prompt_usage = [None] * n_prompts
+        usage = {}
+        for offset, cur_n, cur_result in chunks:
+            # a batched completion request may not return choices in prompt order, use the index field
+            for c in sorted(cur_result['choices'], key=lambda x: x['index']):
+                per_prompt[offset + c['index'] // cur_n].append(c)
+            for k, v in cur_result['usage'].items():
+                usage[k] = usage.get(k, 0) + v
+            if len(cur_result['choices']) == cur_n:     # the request covers a single prompt, its usage is exact
+                prompt_usage = per_prompt_usage[offset] or {}
+                for k, v in cur_result['usage'].items():
+                    prompt_usage[k] = prompt_usage.get(k, 0) + v
+                per_prompt_usage[offset] = prompt_usage
+        result = chunks[0][2]
+        result['choices'] = [c for p in per_prompt for c in p]
+        for idx, c in enumerate(result['choices']):
+            c['index'] = idx
+        result['usage'] = usage
+        result['usage_per_prompt'] = per_prompt_usage if all([_ is not None for _ in per_prompt_usage]) else None
+        return result
+
+    def _split_usage(self, result, prompts, result_idx_to_eid):
+        """
+        Usage of each eid in a (possibly batched) request.
+        Completion tokens are counted from the returned logprobs tokens, prompt tokens are shared
+        proportionally to the prompt length. Requests sent for a single prompt keep their exact usage.
+        """
+        n = len(result_idx_to_eid) // len(prompts)
+        eids = result_idx_to_eid[::n]
+        usage_per_prompt = result.get('usage_per_prompt', None)
+        if usage_per_prompt is not None:
+            return {eid: dict(u) for eid, u in zip(eids, usage_per_prompt)}
+        if len(eids) == 1:
+            return {eids[0]: dict(result['usage'])}
+        prompt_lens = [len(self.tokenizer.tokenize(p)) if self.tokenizer is not None else len(p) for p in prompts]
+        completion_lens = [0] * len(prompts)
+        for idx, g in enumerate(result['choices']):
+            logprobs = g.get('logprobs', None)
+            completion_lens[idx // n] += len(logprobs['tokens']) if logprobs else len(g.get('text', ''))
+
+        def share(total, lens):
+            res = [total * l // max(sum(lens), 1) for l in lens]
+            res[-1] += total - sum(res)
+            return res
+        prompt_tokens = share(result['usage'].get('prompt_tokens', 0), prompt_lens)
+        completion_tokens = share(result['usage'].get('completion_tokens', 0), completion_lens)
+        return {
+            eid: {'prompt_tokens': p, 'completion_tokens': c, 'total_tokens': p + c}
+            for eid, p, c in zip(eids, prompt_tokens, completion_tokens)
+        }
+
+    def _estimate_tokens(self, prompt, max_tokens, n):
+        prompt_tokens = sum([len(self.tokenizer.tokenize(p)) if self.tokenizer is not None else len(p) // 4 for p in prompt])
+        return prompt_tokens + max_tokens * n * len(prompt)
+
+    def _create(self, create_fn, est_tokens, **kwargs):
+        """
+        Call create_fn with a key from the pool. Failed requests are retried with jittered exponential
+        backoff chosen by the error type, at most max_retries times and until request_deadline seconds.
+        """
+        start_time = time.time()
+        deadline = start_time + self.request_deadline
+        attempt, last_error = 0, None
+        while True:
+            try:
+                key = self.key_pool.acquire(est_tokens, deadline=deadline)
+            except RequestFailed as e:
+                if last_error is None:
+                    raise
+                # the keys are throttled by the failed attempts, the request error is the cause
+                raise RequestFailed(f'Request failed after {attempt} attempts, no api key free before the deadline: {last_error}') from e
+            try:
+                print(f"Using openai api key: {key}, Sampling {kwargs['n']}")
+                attempt_start = time.time()
+                result, key = self._hedged_create(create_fn, key, est_tokens, kwargs)
+                self._record_latency(kwargs, time.time() - attempt_start)
+                if result['usage']['prompt_tokens'] is None:  # streams do not report prompt tokens
+                    result['usage']['prompt_tokens'] = self._estimate_tokens(kwargs['prompt'] if 'prompt' in kwargs else [m['content'] for m in kwargs['messages']], 0, 0)
+                    result['usage']['total_tokens'] = result['usage']['prompt_tokens'] + result['usage']['completion_tokens']
+                self.key_pool.report_success(key, est_tokens, result['usage']['total_tokens'])
+                print('Openai api inference time:', time.time() - start_time)
+                return result
+            except Exception as e:
+                retry, delay = self.key_pool.report_error(key, e, attempt, est_tokens)
+                attempt, last_error = attempt + 1, e
+                if not retry or attempt > self.max_retries or time.time() + delay > deadline:
+                    raise RequestFailed(f'Request failed after {attempt} attempts: {e}') from e
+                print(e, f'Retry in {delay:.1f}s.')
+                time.sleep(delay)
+
+    async def _acreate(self, create_fn, est_tokens, **kwargs):
+        """
+        Coroutine version of _create.
+        """
+        start_time = time.time()
+        deadline = start_time + self.request_deadline
+        attempt, last_error = 0, None
+        while True:
+            key, wait = self.key_pool.try_acquire(est_tokens)
+            if key is None:
+                if time.time() + wait > deadline and last_error is not None:
+                    raise RequestFailed(f'Request failed after {attempt} attempts, no api key free before the deadline: {last_error}')
+                if time.time() + wait > deadline:
+                    raise RequestFailed(f'Timed out waiting for an api key, the next one is free in {wait:.1f}s, after the deadline')
+                await asyncio.sleep(wait)
+                continue
+            try:
+                print(f"Using openai api key: {key}, Sampling {kwargs['n']}")
+                attempt_start = time.time()
+                result, key = await self._ahedged_create(create_fn, key, est_tokens, kwargs)
+                self._record_latency(kwargs, time.time() - attempt_start)
+                self.key_pool.report_success(key, est_tokens, result['usage']['total_tokens'])
+                print('Openai api inference time:', time.time() - start_time)
+                return result
+            except Exception as e:
+                retry, delay = self.key_pool.report_error(key, e, attempt, est_tokens)
+                attempt, last_error = attempt + 1, e
+                if not retry or attempt > self.max_retries or time.time() + delay > deadline:
+                    raise RequestFailed(f'Request failed after {attempt} attempts: {e}') from e
+                print(e, f'Retry in {delay:.1f}s.')
+                await asyncio.sleep(delay)
+
+    def _hedge_delay(self, kwargs):
+        # streams are not hedged, their checkers must see a single request
+        if self.hedge_percentile <= 0 or 'on_delta' in kwargs:
+            return None
+        tracker = self.latency_trackers.get(kwargs.get('engine', kwargs.get('model')), None)
+        return tracker.percentile(self.hedge_percentile) if tracker is not None else None
+
+    def _record_latency(self, kwargs, latency):
+        # for a hedged request this is a lower bound of the latency of the first request, which is what the percentile is about
+        engine = kwargs.get('engine', kwargs.get('model'))
+        if engine not in self.latency_trackers:
+            self.latency_trackers[engine] = LatencyTracker(
+                window=getattr(self.args, 'hedge_window', 200),
+                min_samples=getattr(self.args, 'hedge_min_samples', 20)
+            )
+        self.latency_trackers[engine].add(latency)
+
+    def _backup_key(self, key, est_tokens):
+        # another key if the pool has one, a backup request on the same key still helps against slow servers
+        try:
+            backup_key, _ = self.key_pool.try_acquire(est_tokens, exclude=(key,) if len(self.key_pool) > 1 else ())
+        except RequestFailed:
+            return None
+        return backup_key
+
+    def _settle_loser(self, key, est_tokens, result=None, error=None):
+        """
+        Report the request that lost the race to the key pool and count the tokens it spent.
+        """
+        if error is not None:
+            self.key_pool.report_error(key, error, 0, est_tokens)
+            return
+        used = result['usage']['total_tokens'] if result is not None else 0
+        self.key_pool.report_success(key, est_tokens, used)
+        self._count_hedge('extra_tokens', used)
+
+    def _count_hedge(self, name, n=1):
+        with self._hedge_lock:
+            self.hedge_stats[name] += n
+
+    def hedge_summary(self):
+        """
+        Copy of hedge_stats, once the losing requests still running in their threads are finished and counted.
+        """
+        with self._hedge_lock:
+            executor, self._hedge_executor = self._hedge_executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+        with self._hedge_lock:
+            return dict(self.hedge_stats)
+
+    def _hedge_pool(self):
+        """
+        Thread pool of the synchronous hedged requests, created once under _hedge_lock.
+        Every request in flight takes at most two workers (first request and backup), and the loser of a race keeps
+        its worker until it finishes, so the pool holds 2 * max_in_flight workers plus max_in_flight for the losers.
+        When more losers are still running, new requests wait in the pool queue until one of them finishes.
+        """
+        with self._hedge_lock:
+            if self._hedge_executor is None:
+                self._hedge_executor = concurrent.futures.ThreadPoolExecutor(max_workers=3 * self.max_in_flight)
+            return self._hedge_executor
+
+    def _hedged_create(self, create_fn, key, est_tokens, kwargs):
+        """
+        Call create_fn on key. Once the hedge delay is over, the same request is sent on a backup key and the
+        first successful answer wins, the other request is left to finish in its thread.
+        Return (result, key of the winning request), errors of the first request are raised when both fail.
+        """
+        delay = self._hedge_delay(kwargs)
+        if delay is None:
+            return create_fn(api_key=key, **kwargs), key
+        executor = self._hedge_pool()
+        primary = executor.submit(functools.partial(create_fn, api_key=key, **kwargs))
+        try:
+            return primary.result(timeout=delay), key
+        except concurrent.futures.TimeoutError:
+            pass
+        backup_key = self._backup_key(key, est_tokens)
+        if backup_key is None:
+            return primary.result(), key
+        print(f"Hedging: no answer after {delay:.1f}s, duplicate request on key: {backup_key}")
+        self._count_hedge('hedged')
+        backup = executor.submit(functools.partial(create_fn, api_key=backup_key, **kwargs))
+        remaining = {primary: key, backup: backup_key}
+        primary_error = None
+        while len(remaining) > 0:
+            done, _ = concurrent.futures.wait(remaining, return_when=concurrent.futures.FIRST_COMPLETED)
+            for f in done:
+                k = remaining.pop(f)
+                if f.exception() is not None:
+                    if f is primary:
+                        primary_error = f.exception()
+                    else:
+                        self._settle_loser(k, est_tokens, error=f.exception())
+                    continue
+                if primary_error is not None:
+                    self.key_pool.report_error(key, primary_error, 0, est_tokens)
+                for loser, loser_key in remaining.items():
+                    loser.add_done_callback(lambda x, k=loser_key: self._settle_loser(
+                        k, est_tokens, result=x.result() if x.exception() is None else None, error=x.exception()))
+                if f is backup:
+                    self._count_hedge('won')
+                return f.result(), k
+        raise primary_error
+
+    async def _ahedged_create(self, create_fn, key, est_tokens, kwargs):
+        """
+        Coroutine version of _hedged_create, the losing request is cancelled.
+        """
+        delay = self._hedge_delay(kwargs)
+        if delay is None:
+            return await create_fn(api_key=key, **kwargs), key
+        primary = asyncio.ensure_future(create_fn(api_key=key, **kwargs))
+        done, _ = await asyncio.wait([primary], timeout=delay)
+        backup_key = self._backup_key(key, est_tokens) if len(done) == 0 else None
+        if backup_key is None:
+            return await primary, key
+        print(f"Hedging: no answer after {delay:.1f}s, duplicate request on key: {backup_key}")
+        self._count_hedge('hedged')
+        backup = asyncio.ensure_future(create_fn(api_key=backup_key, **kwargs))
+        remaining = {primary: key, backup: backup_key}
+        primary_error = None
+        try:
+            while len(remaining) > 0:
+                done, _ = await asyncio.wait(remaining, return_when=asyncio.FIRST_COMPLETED)
+                for f in done:
+                    k = remaining.pop(f)
+                    if f.exception() is not None:
+                        if f is primary:
+                            primary_error = f.exception()
+                        else:
+                            self._settle_loser(k, est_tokens, error=f.exception())
+                        continue
+                    if primary_error is not None:
+                        self.key_pool.report_error(key, primary_error, 0, est_tokens)
+                    if f is backup:
+                        self._count_hedge('won')
+                    return f.result(), k
+            raise primary_error
+        finally:
+            for loser, loser_key in remaining.items():
+                if loser.done() and not loser.cancelled():  # finished together with the winner
+                    self._settle_loser(loser_key, est_tokens, result=loser.result() if loser.exception() is None else None, error=loser.exception())
+                    continue
+                # the prompt of a cancelled request is billed, its completion is not known
+                loser.cancel()
+                prompt = kwargs['prompt'] if 'prompt' in kwargs else [m['content'] for m in kwargs['messages']]
+                self._settle_loser(loser_key, est_tokens, result={'usage': {'total_tokens': self._estimate_tokens(prompt, 0, 0)}})
+
+    def _call_stream_api(
             self,
+            stream_checkers: List,
             engine: str,
             prompt: Union[str, List],
             max_tokens,
             temperature: float,
             top_p: float,
             n: int,
-            stop: List[str]
+            stop: List[str],
+            logprobs: int = 1
     ):
-        start_time = time.time()
-        result = None
-        MAX_N_SAMPLING = 1000  # @mengkang adjust the parameter if needed
-        count = n
-        while count > 0:
-            try:
-                key = self.keys[self.current_key_id]
-                # self.current_key_id = (self.current_key_id + 1) % len(self.keys)
-                cur_sample = min(count, MAX_N_SAMPLING)
-                print(f"Using openai api key: {key}, Sampling {cur_sample}, Left {count}")
-                cur_result = openai.Completion.create(
-                    engine=engine,
-                    prompt=prompt,
-                    api_key=key,
-                    max_tokens=max_tokens,
-                    temperature=temperature,
-                    top_p=top_p,
-                    n=cur_sample,
-                    stop=stop,
-                    # remove the stop tokens. If removed, post-process of generation result is needed
-                    logprobs=1
-                )
-                count -= cur_sample
-                if result is None:
-                    result = cur_result
+        """
+        Streaming request. stream_checkers[i](index, text so far, finished) is called on every delta of a
+        sample of prompt i and returns True to cut it, after the request stream_checkers[i].resolve(index)
+        gives the text replacing a cut sample, or None to drop it (finish_reason 'invalid').
+        """
+        chunks = []
+        if self._is_completion_engine(engine):
+            # one stream for all prompts, choice index // n is the prompt
+            def on_delta(index, text, finished):
+                return stream_checkers[index // n](index, text, finished)
+            requests = [(0, dict(engine=engine, prompt=prompt), on_delta, self.backend.stream_completion, prompt)]
+        else:
+            requests = [(p_idx, dict(model=engine, messages=[{'role':'user', 'content':p}]), stream_checkers[p_idx], self.backend.stream_chat, [p])
+                        for p_idx, p in enumerate(prompt)]
+        for offset, request, on_delta, stream_fn, cur_prompts in requests:
+            cur_result = self._create(
+                stream_fn,
+                self._estimate_tokens(cur_prompts, max_tokens, n),
+                on_delta=on_delta,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                top_p=top_p,
+                n=n,
+                stop=stop,
+                **request
+            )
+            for c in cur_result['choices']:
+                if c['finish_reason'] != 'cut':
+                    continue
+                checker = stream_checkers[offset + c['index'] // n]
+                text = checker.resolve(c['index'])
+                if text is None:
+                    c['finish_reason'] = 'invalid'
+                elif 'message' in c:
+                    c['message']['content'] = text
                 else:
-                    # result['choices'].append(cur_result['choices'])
-                    result['choices'] += cur_result['choices']
-                print('Openai api inference time:', time.time() - start_time)
-            except Exception as e:
-                print(e, 'Retry.')
-                self.current_key_id = (self.current_key_id + 1) % len(self.keys)
-                time.sleep(5)
-        return result
+                    c['text'] = text
+            chunks.append((offset, n, cur_result))
+        if getattr(self.args, 'verbose', False):
+            cut = [c['finish_reason'] for _, _, r in chunks for c in r['choices']]
+            print(f"Streaming: {cut.count('cut')} samples cut as duplicates, {cut.count('invalid')} dropped for unknown actions")
+        return self._merge_chunks(chunks, len(prompt))
+
+    def _split_n(self, n):
+        """
+        Sample counts of the sub-requests drawing n samples of a prompt. Each sub-request takes at most
+        max_n_per_request samples, and with fan_out the samples are spread over that many concurrent
+        sub-requests (one per key of the pool when fan_out is 0), the key pool gives each one the key with
+        the most budget left.
+        """
+        MAX_N_SAMPLING = self.args.max_n_per_request if getattr(self.args, 'max_n_per_request', 0) > 0 else 1000  # @mengkang adjust the parameter if needed
+        fan_out = getattr(self.args, 'fan_out', 1)
+        n_requests = max(-(-n // MAX_N_SAMPLING), fan_out if fan_out > 0 else len(self.key_pool))
+        n_requests = max(1, min(n_requests, n))
+        return [n // n_requests + (1 if i < n % n_requests else 0) for i in range(n_requests)]
+
+    def _run_sub_requests(self, calls):
+        # sub-requests of one call run in threads, results keep the order of calls
+        if len(calls) == 1:
+            return [calls[0]()]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(calls)) as executor:
+            return list(executor.map(lambda call: call(), calls))
 
+    def _codex_sub_requests(self, asynchronous, engine, prompt, max_tokens, temperature, top_p, n, stop, logprobs):
+        return [(0, cur_sample, functools.partial(
+            self._acreate if asynchronous else self._create,
+            self.backend.acompletion if asynchronous else self.backend.completion,
+            self._estimate_tokens(prompt, max_tokens, cur_sample),
+            engine=engine,
+            prompt=prompt,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            top_p=top_p,
+            n=cur_sample,
+            stop=stop,
+            # remove the stop tokens. If removed, post-process of generation result is needed
+            logprobs=logprobs
+        )) for cur_sample in self._split_n(n)]
+
+    def _chat_sub_requests(self, asynchronous, engine, prompt, max_tokens, temperature, top_p, n, stop):
+        # the chat endpoint takes one conversation per request, batched prompts are sent separately
+        return [(p_idx, cur_sample, functools.partial(
+            self._acreate if asynchronous else self._create,
+            self.backend.achat if asynchronous else self.backend.chat,
+            self._estimate_tokens([cur_prompt], max_tokens, cur_sample),
+            model=engine,
+            messages=[{'role':'user', 'content':cur_prompt}],
+            max_tokens=max_tokens,
+            temperature=temperature,
+            top_p=top_p,
+            n=cur_sample,
+            stop=stop,
+            # FIXME : remove the stop tokens
+            # logprobs=1
+        )) for p_idx, cur_prompt in enumerate(prompt) for cur_sample in self._split_n(n)]
+
+    def _call_codex_api(
+            self,
+            engine: str,
+            prompt: Union[str, List],
+            max_tokens,
+            temperature: float,
+            top_p: float,
+            n: int,
+            stop: List[str],
+            logprobs: int = 1
+    ):
+        sub_requests = self._codex_sub_requests(False, engine, prompt, max_tokens, temperature, top_p, n, stop, logprobs)
+        results = self._run_sub_requests([_[2] for _ in sub_requests])
+        return self._merge_chunks([(offset, cur_n, r) for (offset, cur_n, _), r in zip(sub_requests, results)], len(prompt))
+
+    async def _acall_codex_api(
+            self,
+            engine: str,
+            prompt: Union[str, List],
+            max_tokens,
+            temperature: float,
+            top_p: float,
+            n: int,
+            stop: List[str],
+            logprobs: int = 1
+    ):
+        sub_requests = self._codex_sub_requests(True, engine, prompt, max_tokens, temperature, top_p, n, stop, logprobs)
+        results = await asyncio.gather(*[_[2]() for _ in sub_requests])
+        return self._merge_chunks([(offset, cur_n, r) for (offset, cur_n, _), r in zip(sub_requests, results)], len(prompt))
 
     def _call_chat_api(
             self,
@@ -147,44 +676,24 @@ class Generator(object):
             temperature: float,
             top_p: float,
             n: int,
-            stop: List[str]
+            stop: List[str],
+            logprobs: int = 1
     ):
-        start_time = time.time()
-        result = None
-        MAX_N_SAMPLING = 1000  # FIXME @mengkang 这里的sampling num是一个可以自己调整的超参数，即每次生成采样的次数
-        count = n
-        prompt = prompt[0]
-        max_retry_times, retry_cnt = 5, 0
-        while count > 0:
-            try:
-                key = self.keys[self.current_key_id]
-                self.current_key_id = (self.current_key_id + 1) % len(self.keys)
-                cur_sample = min(count, MAX_N_SAMPLING)
-                print(f"Using openai api key: {key}, Sampling {cur_sample}, Left {count}")
-                cur_result = openai.ChatCompletion.create(
-                    model=engine,
-                    messages=[{'role':'user', 'content':prompt}],
-                    api_key=key,
-                    max_tokens=max_tokens,
-                    temperature=temperature,
-                    top_p=top_p,
-                    n=cur_sample,
-                    stop=stop,
-                    # FIXME : remove the stop tokens
-                    # logprobs=1
-                )
-                count -= cur_sample
-                if result is None:
-                    result = cur_result
-                else:
-                    # result['choices'].append(cur_result['choices'])
-                    result['choices'] += cur_result['choices']
-                print('Openai api inference time:', time.time() - start_time)
-            except Exception as e:
-                print(e, 'Retry.')
-                # retry_cnt += 1
-                # if retry_cnt == max_retry_times:
-                #     result = {'choices':[{'message':{'content': ''}}], 'usage':0}
-                #     break
-                time.sleep(1)
-        return result
\ No newline at end of file
+        sub_requests = self._chat_sub_requests(False, engine, prompt, max_tokens, temperature, top_p, n, stop)
+        results = self._run_sub_requests([_[2] for _ in sub_requests])
+        return self._merge_chunks([(offset, cur_n, r) for (offset, cur_n, _), r in zip(sub_requests, results)], len(prompt))
+
+    async def _acall_chat_api(
+            self,
+            engine: str,
+            prompt: Union[str, List],
+            max_tokens,
+            temperature: float,
+            top_p: float,
+            n: int,
+            stop: List[str],
+            logprobs: int = 1
+    ):
+        sub_requests = self._chat_sub_requests(True, engine, prompt, max_tokens, temperature, top_p, n, stop)
+        results = await asyncio.gather(*[_[2]() for _ in sub_requests])
+        return self._merge_chunks([(offset, cur_n, r) for (offset, cur_n, _), r in zip(sub_requests, results)], len(prompt))
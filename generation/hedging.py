@@ -0,0 +1,52 @@
+# Online request latency statistics used for hedging
+import json
+import threading
+from collections import deque
+
+
+class LatencyTracker(object):
+    """
+    Latencies of the last window requests of one engine.
+    """
+
+    def __init__(self, window=200, min_samples=20):
+        self.window = window
+        self.min_samples = min_samples
+        self._latencies = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_lock'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def add(self, latency):
+        with self._lock:
+            self._latencies.append(latency)
+
+    def percentile(self, p):
+        """
+        The p-th percentile (0-100) of the recorded latencies, None until min_samples requests are recorded.
+        """
+        with self._lock:
+            if len(self._latencies) < self.min_samples:
+                return None
+            latencies = sorted(self._latencies)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p / 100))]
+
+
+def save_hedge_stats(path, stats_list):
+    """
+    Sum the Generator.hedge_summary() of every worker and save it to the json file path.
+    The extra tokens of the duplicate requests are not part of the usage of any task, this is where they are counted.
+    """
+    total = {'hedged': 0, 'won': 0, 'extra_tokens': 0}
+    for stats in stats_list:
+        for k, v in stats.items():
+            total[k] = total.get(k, 0) + v
+    json.dump(obj=total, fp=open(path, 'w', encoding='utf'), indent=4)
+    return total
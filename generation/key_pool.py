@@ -0,0 +1,175 @@
+# Api key pool shared by all worker processes
+import time
+import random
+import threading
+from multiprocessing.managers import SyncManager
+
+
+# error name -> (retry or not, base delay in seconds, the error is caused by the key itself)
+# errors are matched by class name so that other backends can raise errors with the same names
+ERROR_POLICY = {
+    'RateLimitError': (True, 2.0, True),
+    'ServiceUnavailableError': (True, 1.0, False),
+    'APIError': (True, 1.0, False),
+    'Timeout': (True, 1.0, False),
+    'TimeoutError': (True, 1.0, False),
+    'APIConnectionError': (True, 1.0, False),
+    'TryAgain': (True, 1.0, False),
+    'AuthenticationError': (False, 0.0, True),
+    'PermissionError': (False, 0.0, True),
+    'InvalidRequestError': (False, 0.0, False),
+}
+DEFAULT_POLICY = (True, 5.0, False)
+MAX_DELAY = 60.0
+
+
+class RequestFailed(Exception):
+    pass
+
+
+def backoff_delay(base, attempt, max_delay=MAX_DELAY):
+    # exponential backoff, half of it jittered
+    delay = min(max_delay, base * 2 ** attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+class KeyBuckets(object):
+    """
+    The bucket states of the keys of a KeyPool. In a shared pool this object lives in the manager process, so every
+    method is a single proxy call that reads and updates the states under the lock of the object.
+    """
+
+    def __init__(self, keys, rpm=0, tpm=0):
+        self.keys = list(keys)
+        self.rpm = rpm
+        self.tpm = tpm
+        now = time.time()
+        # key -> [request budget, token budget, last refill time, cooldown until, consecutive failures, disabled]
+        self._state = {k: [float(rpm), float(tpm), now, 0.0, 0, False] for k in self.keys}
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_lock'] = None   # a local pool is copied, not shared
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _refill(self, s, now):
+        elapsed = now - s[2]
+        if self.rpm > 0:
+            s[0] = min(float(self.rpm), s[0] + elapsed * self.rpm / 60)
+        if self.tpm > 0:
+            s[1] = min(float(self.tpm), s[1] + elapsed * self.tpm / 60)
+        s[2] = now
+
+    def try_acquire(self, est_tokens=0, exclude=()):
+        if self.tpm > 0:
+            est_tokens = min(est_tokens, self.tpm)  # a request larger than the bucket would never fit
+        with self._lock:
+            now = time.time()
+            best_key, best_score, min_wait = None, None, None
+            for k in self.keys:
+                s = self._state[k]
+                if s[5] or k in exclude:
+                    continue
+                self._refill(s, now)
+                wait = max(0.0, s[3] - now)
+                if self.rpm > 0 and s[0] < 1:
+                    wait = max(wait, (1 - s[0]) * 60 / self.rpm)
+                if self.tpm > 0 and s[1] < est_tokens:
+                    wait = max(wait, (est_tokens - s[1]) * 60 / self.tpm)
+                if wait > 0:
+                    min_wait = wait if min_wait is None else min(min_wait, wait)
+                    continue
+                # prefer the key with the most budget left
+                score = (s[1] / self.tpm if self.tpm > 0 else 1) + (s[0] / self.rpm if self.rpm > 0 else 1)
+                if best_score is None or score > best_score:
+                    best_key, best_score = k, score
+            if best_key is None:
+                if min_wait is None:
+                    raise RequestFailed('No usable api key left in the pool')
+                return None, min_wait
+            s = self._state[best_key]
+            s[0] -= 1 if self.rpm > 0 else 0
+            s[1] -= est_tokens if self.tpm > 0 else 0
+            return best_key, 0
+
+    def report_success(self, key, est_tokens, used_tokens):
+        with self._lock:
+            s = self._state[key]
+            if self.tpm > 0:
+                # give back (or take) the difference between the estimation and the real usage
+                s[1] += min(est_tokens, self.tpm) - used_tokens
+            s[4] = 0
+
+    def report_error(self, key, error_name, attempt, est_tokens=0):
+        retry, base, key_error = ERROR_POLICY.get(error_name, DEFAULT_POLICY)
+        with self._lock:
+            s = self._state[key]
+            if self.tpm > 0:    # failed requests are not billed
+                s[1] += min(est_tokens, self.tpm)
+            if not key_error:
+                return retry, backoff_delay(base, attempt)
+            if not retry:   # the key itself is broken
+                s[5] = True
+            else:   # throttled key: cool it down, other keys can take the retry immediately
+                s[3] = time.time() + backoff_delay(base, s[4])
+                s[4] += 1
+            has_other_key = any([not self._state[k][5] for k in self.keys])
+        return has_other_key, 0.0
+
+
+class KeyPoolManager(SyncManager):
+    """
+    Manager of the shared KeyPools, pass a started one as the manager of KeyPool.
+    """
+
+
+KeyPoolManager.register('KeyBuckets', KeyBuckets)
+
+
+class KeyPool(object):
+    """
+    Api keys with a request bucket (requests per minute) and a token bucket (tokens per minute) for each key.
+    When a KeyPoolManager is given the bucket states live in the manager, so every pool worker
+    draws from the same keys instead of a fixed shard. rpm / tpm of 0 means no limit.
+    """
+
+    def __init__(self, keys, rpm=0, tpm=0, manager=None):
+        self.keys = list(keys)
+        self.rpm = rpm
+        self.tpm = tpm
+        self._buckets = KeyBuckets(self.keys, rpm, tpm) if manager is None else manager.KeyBuckets(self.keys, rpm, tpm)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def try_acquire(self, est_tokens=0, exclude=()):
+        """
+        Take budget for one request of about est_tokens tokens, on a key not in exclude.
+        Return (key, 0) on success, otherwise (None, seconds to wait before trying again).
+        """
+        return self._buckets.try_acquire(est_tokens, tuple(exclude))
+
+    def acquire(self, est_tokens=0, deadline=None):
+        while True:
+            key, wait = self.try_acquire(est_tokens)
+            if key is not None:
+                return key
+            if deadline is not None and time.time() + wait > deadline:
+                raise RequestFailed(f'Timed out waiting for an api key, the next one is free in {wait:.1f}s, after the deadline')
+            time.sleep(wait)
+
+    def report_success(self, key, est_tokens, used_tokens):
+        self._buckets.report_success(key, est_tokens, used_tokens)
+
+    def report_error(self, key, error, attempt, est_tokens=0):
+        """
+        Update the key after a failed request.
+        Return (retry or not, seconds the caller should sleep before retrying).
+        """
+        # errors are matched by class name, the error itself may not be picklable for the manager
+        return self._buckets.report_error(key, type(error).__name__, attempt, est_tokens)
@@ -0,0 +1,234 @@
+# Local Hugging Face causal LM backend (CPU), needs torch and transformers
+import os
+import copy
+import asyncio
+import threading
+from generation.backends import Backend
+
+ROOT_DIR = os.path.join(os.path.dirname(__file__))
+
+
+class InvalidRequestError(Exception):
+    pass
+
+
+# past key values are a Cache object in recent transformers (extended in place by the model) and
+# tuples of (key, value) of shape [batch, head, seq, dim] in older ones, the helpers below return new objects
+def _slice_past(past_key_values, length):
+    if hasattr(past_key_values, 'crop'):
+        past_key_values = copy.deepcopy(past_key_values)
+        # a negative value removes that many tokens from the end
+        past_key_values.crop(length - past_key_values.get_seq_length())
+        return past_key_values
+    return tuple((k[:, :, :length], v[:, :, :length]) for k, v in past_key_values)
+
+
+def _expand_past(past_key_values, batch_size):
+    if hasattr(past_key_values, 'batch_repeat_interleave'):
+        past_key_values = copy.deepcopy(past_key_values)
+        past_key_values.batch_repeat_interleave(batch_size)
+        return past_key_values
+    return tuple((k.expand(batch_size, -1, -1, -1).contiguous(), v.expand(batch_size, -1, -1, -1).contiguous()) for k, v in past_key_values)
+
+
+class LocalHFBackend(Backend):
+    """
+    Runs a causal LM on CPU. The bundled utils/gpt2 folder holds the config and the tokenizer,
+    the weights have to be put next to them (or model_path pointed to another model).
+    The key / value states of prompts are kept in a small LRU cache. A new prompt reuses the states of its
+    longest common token prefix with a cached prompt, so the few-shot prefix of plan generation and the
+    instruction prefix of grounded deciding are encoded once, and the sampling_n samples of a prompt are
+    decoded as one batch from a single prefill.
+    The usage counts the prompt tokens that were encoded, those taken from the cache are free.
+    """
+    requires_key = False
+    name = 'local'
+    reuses_prompt_prefix = True
+
+    def __init__(self, model_path=None, prefix_cache_size=4, n_threads=0, top_logprobs=5, seed=42):
+        self.model_path = model_path if model_path is not None else os.path.join(ROOT_DIR, '..', 'utils', 'gpt2')
+        self.prefix_cache_size = prefix_cache_size
+        self.n_threads = n_threads
+        self.top_logprobs = top_logprobs
+        self.seed = seed
+        self._model = None
+        self._tokenizer = None
+        self._prefix_cache = []     # [(token ids, past key values, logits of the last token)], most recent last
+        self._lock = threading.Lock()
+
+    def model_id(self):
+        return os.path.realpath(self.model_path)
+
+    def __getstate__(self):
+        # the model is loaded in the worker process
+        state = self.__dict__.copy()
+        state.update({'_model': None, '_tokenizer': None, '_prefix_cache': [], '_lock': None})
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._model is None:
+            import torch
+            from transformers import AutoTokenizer, AutoModelForCausalLM
+            if self.n_threads > 0:
+                torch.set_num_threads(self.n_threads)
+            torch.manual_seed(self.seed)
+            self._tokenizer = AutoTokenizer.from_pretrained(self.model_path)
+            self._model = AutoModelForCausalLM.from_pretrained(self.model_path)
+            self._model.eval()
+        return self._model, self._tokenizer
+
+    def _prefill(self, ids):
+        """
+        Return (past key values, logits of the last token, number of tokens taken from the cache) of ids,
+        reusing the longest cached prefix.
+        """
+        import torch
+        model, _ = self._load()
+        best_idx, best_len = None, 0
+        for idx, (cached_ids, _, _) in enumerate(self._prefix_cache):
+            common = 0
+            for a, b in zip(cached_ids, ids):
+                if a != b:
+                    break
+                common += 1
+            if common > best_len:
+                best_idx, best_len = idx, common
+        if best_idx is not None:
+            cached_ids, past, last_logits = self._prefix_cache.pop(best_idx)
+            self._prefix_cache.append((cached_ids, past, last_logits))
+            if best_len == len(ids) == len(cached_ids):
+                return past, last_logits, best_len
+            # at least the last token is encoded again to get its logits
+            best_len = min(best_len, len(ids) - 1)
+            past = _slice_past(past, best_len) if best_len > 0 else None
+        else:
+            past = None
+        with torch.no_grad():
+            out = model(
+                input_ids=torch.tensor([ids[best_len:]]),
+                past_key_values=past,
+                use_cache=True
+            )
+        past, last_logits = out.past_key_values, out.logits[0, -1]
+        self._prefix_cache.append((list(ids), past, last_logits))
+        if len(self._prefix_cache) > self.prefix_cache_size:
+            self._prefix_cache.pop(0)
+        return past, last_logits, best_len
+
+    def _sample(self, logits, temperature, top_p):
+        import torch
+        if temperature <= 0:
+            return logits.argmax(dim=-1)
+        probs = torch.softmax(logits / temperature, dim=-1)
+        if top_p < 1.0:
+            sorted_probs, sorted_idx = probs.sort(dim=-1, descending=True)
+            # drop tokens outside the nucleus, the most probable one is always kept
+            drop = sorted_probs.cumsum(dim=-1) - sorted_probs > top_p
+            sorted_probs = sorted_probs.masked_fill(drop, 0.0)
+            probs = torch.zeros_like(probs).scatter(-1, sorted_idx, sorted_probs)
+        return torch.multinomial(probs, num_samples=1).squeeze(-1)
+
+    def _generate(self, prompt, max_tokens, temperature, top_p, n, stop, on_delta=None, index_offset=0, logprobs=None):
+        """
+        Sample n continuations of prompt, with the logprobs top tokens of every step (self.top_logprobs when None).
+        When on_delta is given it is called after every new token (see Backend.stream_completion), samples it cuts
+        stop decoding.
+        """
+        import torch
+        model, tokenizer = self._load()
+        ids = tokenizer.encode(prompt)
+        max_positions = getattr(model.config, 'n_positions', getattr(model.config, 'max_position_embeddings', None))
+        if max_positions is not None and len(ids) + max_tokens > max_positions:
+            raise InvalidRequestError(f'{len(ids)} prompt tokens + {max_tokens} generation tokens exceed the context of {max_positions}')
+        stop = [s for s in (stop or []) if s]
+        n_top = self.top_logprobs if logprobs is None else logprobs
+        past, last_logits, n_cached = self._prefill(ids)
+        past = _expand_past(past, n)
+        logits = last_logits.unsqueeze(0).expand(n, -1)
+        tokens = [[] for _ in range(n)]
+        token_logprobs = [[] for _ in range(n)]
+        top_logprobs = [[] for _ in range(n)]
+        texts = [''] * n
+        finished = [False] * n
+        finish_reasons = ['length'] * n
+
+        def strip_stop(text):
+            return text[:min([text.find(s) for s in stop if s in text] or [len(text)])]
+        with torch.no_grad():
+            for _ in range(max_tokens):
+                next_ids = self._sample(logits, temperature, top_p)
+                step_logprobs = torch.log_softmax(logits, dim=-1)
+                top = step_logprobs.topk(n_top, dim=-1)
+                for i in range(n):
+                    if finished[i]:
+                        continue
+                    t = next_ids[i].item()
+                    if t == tokenizer.eos_token_id:
+                        finished[i], finish_reasons[i] = True, 'stop'
+                    else:
+                        tokens[i].append(t)
+                        token_logprobs[i].append(step_logprobs[i, t].item())
+                        top_logprobs[i].append({tokenizer.decode([j]): v for j, v in zip(top.indices[i].tolist(), top.values[i].tolist())})
+                        texts[i] = tokenizer.decode(tokens[i])
+                        if any([s in texts[i] for s in stop]):
+                            finished[i], finish_reasons[i] = True, 'stop'
+                    if on_delta is not None and on_delta(index_offset + i, strip_stop(texts[i]), finished[i]):
+                        finished[i], finish_reasons[i] = True, 'cut'
+                if all(finished):
+                    break
+                # finished samples keep decoding in the batch, their tokens are ignored
+                out = model(input_ids=next_ids.unsqueeze(-1), past_key_values=past, use_cache=True)
+                past, logits = out.past_key_values, out.logits[:, -1]
+        texts = [strip_stop(t) for t in texts]
+        completion_tokens = sum([len(_) for _ in tokens])
+        return texts, [
+            {'tokens': [tokenizer.decode([t]) for t in tokens[i]], 'token_logprobs': token_logprobs[i], 'top_logprobs': top_logprobs[i]}
+            for i in range(n)
+        ], len(ids) - n_cached, completion_tokens, finish_reasons
+
+    def _completion(self, prompt, max_tokens, temperature, top_p, n, stop, on_delta=None, logprobs=None, **kwargs):
+        prompts = prompt if isinstance(prompt, list) else [prompt]
+        choices = []
+        usage = {'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0}
+        with self._lock:
+            for p_idx, p in enumerate(prompts):
+                texts, sample_logprobs, prompt_tokens, completion_tokens, finish_reasons = self._generate(
+                    p, max_tokens, temperature, top_p, n, stop, on_delta=on_delta, index_offset=p_idx * n, logprobs=logprobs)
+                for idx, (t, l, f) in enumerate(zip(texts, sample_logprobs, finish_reasons)):
+                    choices.append({'text': t, 'index': p_idx * n + idx, 'logprobs': l, 'finish_reason': f})
+                usage['prompt_tokens'] += prompt_tokens
+                usage['completion_tokens'] += completion_tokens
+        usage['total_tokens'] = usage['prompt_tokens'] + usage['completion_tokens']
+        return {'choices': choices, 'usage': usage}
+
+    def _chat(self, messages, max_tokens, temperature, top_p, n, stop, on_delta=None, **kwargs):
+        prompt = '\n'.join([m['content'] for m in messages])
+        with self._lock:
+            texts, _, prompt_tokens, completion_tokens, finish_reasons = self._generate(
+                prompt, max_tokens, temperature, top_p, n, stop, on_delta=on_delta)
+        choices = [{'message': {'role': 'assistant', 'content': t}, 'index': idx, 'finish_reason': f} for idx, (t, f) in enumerate(zip(texts, finish_reasons))]
+        return {'choices': choices, 'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens, 'total_tokens': prompt_tokens + completion_tokens}}
+
+    def completion(self, **kwargs):
+        return self._completion(**kwargs)
+
+    async def acompletion(self, **kwargs):
+        # the model runs in a thread so that the event loop keeps serving other requests
+        return await asyncio.get_running_loop().run_in_executor(None, lambda: self._completion(**kwargs))
+
+    def chat(self, **kwargs):
+        return self._chat(**kwargs)
+
+    async def achat(self, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(None, lambda: self._chat(**kwargs))
+
+    # cut samples stop decoding, so streaming saves local compute
+    def stream_completion(self, on_delta, **kwargs):
+        return self._completion(on_delta=on_delta, **kwargs)
+
+    def stream_chat(self, on_delta, **kwargs):
+        return self._chat(on_delta=on_delta, **kwargs)
@@ -0,0 +1,130 @@
+# Prompt files, layouts and few-shot prompt building with cached token counts
+import os
+import time
+import bisect
+import string
+import threading
+
+
+class PromptBuilder(object):
+    """
+    Builds few-shot prompts of the form prefix + sep + sep.join(shots) + sep + suffix that fit a token budget.
+    Every piece is tokenized once and its count is cached, so the number of shots is found from prefix sums
+    instead of tokenizing the whole prompt for every candidate.
+    Pieces are counted together with the separator in front of them. The gpt2 pre-tokenizer never merges
+    across a boundary between a non-blank character and a newline, so the sum is exact as long as the
+    pieces do not end with blanks (see joins_exactly), and the chosen prompt is only tokenized again otherwise.
+    """
+
+    def __init__(self, tokenizer, sep='\n\n'):
+        self.tokenizer = tokenizer
+        self.sep = sep
+        self._counts = {}
+
+    def count_tokens(self, text):
+        n_tokens = self._counts.get(text, None)
+        if n_tokens is None:
+            n_tokens = len(self.tokenizer.tokenize(text))
+            self._counts[text] = n_tokens
+        return n_tokens
+
+    @staticmethod
+    def joins_exactly(left, right):
+        """
+        Whether left + right has as many tokens as left and right counted apart.
+        """
+        if left == '' or right == '':
+            return True
+        return (not left[-1].isspace() and right[0] == '\n') or (left[-1] == '\n' and not right[0].isspace())
+
+    def build(self, prefix, shots, suffix):
+        return prefix + self.sep + self.sep.join(shots) + self.sep + suffix
+
+    def fit_few_shot(self, prefix, shots, suffix, max_prompt_tokens, prefix_tokens=None):
+        """
+        The prompt with the largest number of leading shots that stays below max_prompt_tokens.
+        prefix_tokens is the token count of prefix when the caller has it from the counts of its parts.
+        Return (prompt, number of shots used).
+        """
+        if prefix_tokens is None:
+            prefix_tokens = self.count_tokens(prefix)
+        # cum_counts[k] is the number of tokens of the prompt with k shots
+        cum_counts = [prefix_tokens + self.count_tokens(self.sep + suffix)]
+        for shot in shots:
+            cum_counts.append(cum_counts[-1] + self.count_tokens(self.sep + shot))
+        # without shots the two separators are in a row
+        cum_counts[0] = prefix_tokens + self.count_tokens(self.sep + self.sep + suffix)
+        n_shots = bisect.bisect_left(cum_counts, max_prompt_tokens) - 1
+        while True:
+            assert n_shots >= 0, 'the prompt does not fit even without shots'
+            prompt = self.build(prefix, shots[:n_shots], suffix)
+            pieces = [prefix] + [self.sep + shot for shot in shots[:n_shots]] + [self.sep + self.sep + suffix if n_shots == 0 else self.sep + suffix]
+            if all([self.joins_exactly(left, right) for left, right in zip(pieces, pieces[1:])]):
+                return prompt, n_shots  # the sum of the counts is exact
+            if len(self.tokenizer.tokenize(prompt)) < max_prompt_tokens:
+                return prompt, n_shots
+            n_shots -= 1
+
+
+class PromptFile(object):
+    """
+    Content of a prompt file, the modification time it was read at and its token counts.
+    A modified file gets a new PromptFile, so the counts always belong to the text.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.mtime = os.stat(path).st_mtime
+        self.checked_at = time.monotonic()
+        self.text = ''.join(open(path, 'r', encoding='utf').readlines())
+        self._token_counts = {}     # tokenizer name -> number of tokens of text
+
+    def count_tokens(self, tokenizer):
+        name = getattr(tokenizer, 'name_or_path', None) or id(tokenizer)
+        n_tokens = self._token_counts.get(name, None)
+        if n_tokens is None:
+            n_tokens = len(tokenizer.tokenize(self.text))
+            self._token_counts[name] = n_tokens
+        return n_tokens
+
+
+# path -> PromptFile, per process
+_prompt_files = {}
+_prompt_files_lock = threading.Lock()
+# seconds between two checks of the modification time of a prompt file
+PROMPT_FILE_CHECK_INTERVAL = 5.0
+
+
+def get_prompt_file(path):
+    """
+    The PromptFile of path, read once per process. Its modification time is checked at most once every
+    PROMPT_FILE_CHECK_INTERVAL seconds, and the file is read again when it was modified.
+    """
+    prompt_file = _prompt_files.get(path, None)
+    if prompt_file is not None and time.monotonic() - prompt_file.checked_at < PROMPT_FILE_CHECK_INTERVAL:
+        return prompt_file
+    mtime = os.stat(path).st_mtime
+    with _prompt_files_lock:
+        prompt_file = _prompt_files.get(path, None)
+        if prompt_file is None or prompt_file.mtime != mtime:
+            prompt_file = PromptFile(path)
+            _prompt_files[path] = prompt_file
+        prompt_file.checked_at = time.monotonic()
+    return prompt_file
+
+
+class PromptLayout(object):
+    """
+    A prompt layout with {slot} markers, parsed once into literal parts and slots.
+    Slot values are inserted as they are, so they may contain braces.
+    """
+
+    def __init__(self, layout):
+        self.parts = [(literal, slot) for literal, slot, _, _ in string.Formatter().parse(layout)]
+        self.slots = [slot for _, slot in self.parts if slot is not None]
+
+    def fill(self, **slots):
+        missing = [_ for _ in self.slots if _ not in slots]
+        if len(missing) > 0:
+            raise KeyError(f'Missing prompt slots: {missing}')
+        return ''.join([literal + (slots[slot] if slot is not None else '') for literal, slot in self.parts])
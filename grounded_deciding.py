@@ -13,11 +13,14 @@ from typing import List
 import platform
 import multiprocessing
 from generation.generator import Generator
+from generation.key_pool import KeyPool, KeyPoolManager
+from generation.hedging import save_hedge_stats
 from arguments import get_args
 import random
 from utils.env_utils import *
 from utils.data_utils import *
 from utils.exec_utils import *
+from evolving_graph.resources import preload_resources
 random.seed(42)
 # env libraries
 from simulation.evolving_graph.environment import EnvironmentGraph, EnvironmentState
@@ -38,7 +41,58 @@ def construct_program_text(task_name, instruction=None, program=None):
     return res
 
 
-from utils.exec_utils import grounded_exec, calc_gcr
+from utils.exec_utils import grounded_exec, calc_gcr, calc_gcr_list
+
+
+def annotate_one(
+        pid: int,
+        args,
+        generator: Generator,
+        g_eid,
+        dataset,
+        task_to_graph
+):
+    g_data_item = dataset[g_eid]
+    g_item = {
+        'ori_data_item': copy.deepcopy(g_data_item)
+    }
+    metrics = None
+    try:
+        # graph_dict = json.load(open(args.graph_dict_path))
+        graph_dict = task_to_graph[g_data_item['task']]
+        init_graph_dict = copy.deepcopy(graph_dict)
+        executability, state, graph_state_list, info, selected_plan, usage, _traceback, retry_cnt, index_list = grounded_exec(
+            args=args,
+            script_str_list=g_data_item['valid_programs'],
+            graph_dict=graph_dict,
+            task=g_data_item['task'],
+            generator=generator,
+            g_eid=g_eid,
+            goal_conditions=g_data_item['goal_condition']
+        )
+        if executability:
+            # gcr = calc_gcr(init_graph_dict, state.to_dict(), goal_condition=g_data_item['goal_condition'])
+            gcr = max(calc_gcr_list(init_graph_dict, graph_state_list, goal_condition=g_data_item['goal_condition']))
+            sr = 1 if abs(gcr - 1) < 1e-10 else 0
+        else:
+            gcr, sr = 0.0, 0
+        metrics = {"executability": int(executability), "success rate": sr, "gcr": gcr, 'tokens': usage + g_data_item['tokens'], 'retry': retry_cnt}
+        g_item.update(
+            {
+                'plan': selected_plan,
+                'index_list': index_list,
+                'metrics': metrics,
+                'usage': usage,
+                'info': info,
+                'traceback': _traceback,
+            }
+        )
+    except Exception as e:
+        print(f"Process#{pid}: eid#{g_eid}, generation error: {e}")
+        g_item.update({'generation_error':str(e)})
+        print(traceback.format_exc())
+        # raise e
+    return g_item, metrics
 
 
 def worker_annotate(
@@ -57,49 +111,24 @@ def worker_annotate(
     #     sys.stdout = open(f'./log/output_{pid}.log', 'w', encoding='utf')
     g_dict = dict()
     metrics_list = []
-    for g_eid in g_eids:
-        g_data_item = dataset[g_eid]
-        g_dict[g_eid] = {
-            'ori_data_item': copy.deepcopy(g_data_item)
-        }
-        try:
-            # graph_dict = json.load(open(args.graph_dict_path))
-            graph_dict = task_to_graph[g_data_item['task']]
-            init_graph_dict = copy.deepcopy(graph_dict)
-            executability, state, graph_state_list, info, selected_plan, usage, _traceback, retry_cnt, index_list = grounded_exec(
-                args=args,
-                script_str_list=g_data_item['valid_programs'],
-                graph_dict=graph_dict,
-                task=g_data_item['task'],
-                generator=generator,
-                g_eid=g_eid,
-                goal_conditions=g_data_item['goal_condition']
-            )
-            if executability:
-                # gcr = calc_gcr(init_graph_dict, state.to_dict(), goal_condition=g_data_item['goal_condition'])
-                gcr = max([calc_gcr(init_graph_dict, s, goal_condition=g_data_item['goal_condition']) for s in graph_state_list])
-                sr = 1 if abs(gcr - 1) < 1e-10 else 0
-            else:
-                gcr, sr = 0.0, 0
-            metrics = {"executability": int(executability), "success rate": sr, "gcr": gcr, 'tokens': usage + g_data_item['tokens'], 'retry': retry_cnt}
-            g_dict[g_eid].update(
-                {
-                    'plan': selected_plan,
-                    'index_list': index_list,
-                    'metrics': metrics,
-                    'usage': usage,
-                    'info': info,
-                    'traceback': _traceback,
-                }
-            )
+    if generator.max_in_flight > 1:
+        # grounded_exec is synchronous, run several tasks in threads and let them share the generator's event loop
+        from concurrent.futures import ThreadPoolExecutor
+        generator.start_background_loop()
+        with ThreadPoolExecutor(max_workers=generator.max_in_flight) as executor:
+            results = list(executor.map(lambda g_eid: annotate_one(pid, args, generator, g_eid, dataset, task_to_graph), g_eids))
+        generator.stop_background_loop()
+    else:
+        results = [annotate_one(pid, args, generator, g_eid, dataset, task_to_graph) for g_eid in g_eids]
+    for g_eid, (g_item, metrics) in zip(g_eids, results):
+        g_dict[g_eid] = g_item
+        if metrics is not None:
             metrics_list.append(metrics)
-        except Exception as e:
-            print(f"Process#{pid}: eid#{g_eid}, generation error: {e}")
-            g_dict[g_eid].update({'generation_error':str(e)})
-            print(traceback.format_exc())
-            # raise e
+    hedge_stats = generator.hedge_summary()
+    if generator.hedge_percentile > 0:
+        print(f"Process#{pid}: Hedging {hedge_stats}")
     # show_result(metrics_list)
-    return g_dict, metrics_list
+    return g_dict, metrics_list, hedge_stats
 
 
 
@@ -119,12 +148,12 @@ def main(args):
     all_tasks = [_.strip() for _ in open("./debugging/all_tasks_v3_modified.txt").readlines()]
     generation_result = list(filter(lambda x:x['task'] in all_tasks, generation_result))
     print("Number of samples in the dataset:", len(generation_result))
-    # Load openai keys and split
+    # Load openai keys, all processes share one pool with per-key rate limits
     with open(args.api_keys_file, 'r') as f:
-        keys = [line.strip() for line in f.readlines()]
-    keys_process = [[''] for _ in range(args.n_processes)]
-    for _, k in enumerate(keys): keys_process[int(_)%args.n_processes].append(k)
-    keys_process = [_[1:] for _ in keys_process]
+        keys = [line.strip() for line in f.readlines() if line.strip() != '']
+    manager = KeyPoolManager()
+    manager.start()
+    key_pool = KeyPool(keys, rpm=args.key_rpm, tpm=args.key_tpm, manager=manager)
     # Split Dataset
     generate_eids = list(range(len(generation_result)))
     generate_eids_group = [[] for _ in range(args.n_processes)]
@@ -134,11 +163,15 @@ def main(args):
     g_dict = dict()
     worker_results = []
     task_to_graph = json.load(open(args.task_to_graph))
-    pool = multiprocessing.Pool(processes=args.n_processes)
+    # simulator resources are parsed here once, forked workers share them (spawned workers load them in the initializer)
+    preload_resources()
+    pool = multiprocessing.Pool(processes=args.n_processes, initializer=preload_resources)
     for pid in range(args.n_processes):
         from transformers import AutoTokenizer
         tokenizer = AutoTokenizer.from_pretrained(pretrained_model_name_or_path=os.path.join(ROOT_DIR, "utils", "gpt2"))
-        generator = Generator(args, keys=keys_process[pid], tokenizer=tokenizer)
+        generator = Generator(args, keys=key_pool, tokenizer=tokenizer)
+        if pid == 0 and args.vote_batch_size > 0 and not generator.backend.reuses_prompt_prefix:
+            print(f"--vote_batch_size is ignored with the {generator.backend.name} backend, the votes are drawn in one request.")
         worker_results.append(pool.apply_async(worker_annotate, args=(
             pid,
             args,
@@ -151,12 +184,18 @@ def main(args):
 
     # Merge annotation results
     metrics_list_all = []
+    hedge_stats_list = []
     for r in worker_results:
-        worker_g_dict, metrics_list = r.get()
+        worker_g_dict, metrics_list, hedge_stats = r.get()
         metrics_list_all += metrics_list
+        hedge_stats_list.append(hedge_stats)
         g_dict.update(worker_g_dict)
+    if args.hedge_percentile > 0:   # tokens of the duplicate requests, next to the results
+        hedge_stats = save_hedge_stats(os.path.join(args.save_dir, args.grounded_deciding_result_file[:-5] + '_hedging.json'), hedge_stats_list)
+        print(f"Hedging {hedge_stats}")
     pool.close()
     pool.join()
+    manager.shutdown()
     print(f"Elapsed time: {time.time() - start_time}")
     return g_dict
 
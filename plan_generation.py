@@ -13,9 +13,14 @@ from typing import List
 import platform
 import multiprocessing
 from generation.generator import Generator
+from generation.key_pool import KeyPool, KeyPoolManager
+from generation.hedging import save_hedge_stats
+from generation.prompt import PromptBuilder
+from utils.deciding_graph import PlanSetTracker
 from arguments import get_args
 import random
 from utils.env_utils import *
+from evolving_graph.resources import preload_resources
 random.seed(42)
 
 
@@ -58,7 +63,16 @@ def worker_annotate(
     # if pid != 0:
     #     sys.stdout = open(f'./log/output_{pid}.log', 'w', encoding='utf')
     g_dict = dict()
+    set_env_prompt_cache(args.env_prompt_cache)
+    # token counts of the prompt pieces are cached for the whole worker
+    prompt_builder = PromptBuilder(tokenizer)
     built_few_shot_prompts = []
+    pending_prompts = []
+    pending_checkers = []
+    # sampling rounds only pay off when a round does not pay the prompt again
+    adaptive = args.min_sampling_n > 0 and generator.backend.reuses_prompt_prefix
+    if args.min_sampling_n > 0 and not adaptive:
+        print(f"Process#{pid}: --min_sampling_n is ignored with the {generator.backend.name} backend, sampling_n samples are drawn at once.")
     for g_eid in g_eids:
         try:
             g_data_item = dataset[g_eid]
@@ -69,47 +83,174 @@ def worker_annotate(
             n_shots = args.n_shots
             max_prompt_tokens = args.max_api_total_tokens - args.max_generation_tokens
             task = g_data_item['task']
-            assert task_to_idx is None  # retrieve based examplar waiting for implementation
-            examples = retrieval_dataset # fixed prompt
+            if task_to_idx is not None:     # retrieved examplars, the most similar first
+                examples = [retrieval_dataset[idx] for idx in task_to_idx[task]]
+            else:
+                examples = retrieval_dataset # fixed prompt
+            scene = scene_hash(task_to_graph[task])     # the scene is hashed once for the prompt and its token count
             prefix = plan_generation_prompt(
                 # graph_dict=json.load(open(args.graph_dict_path, 'r', encoding='utf')),
                 graph_dict=task_to_graph[task],
-                prefix_path=args.plan_generation_prompt_path
+                prefix_path=args.plan_generation_prompt_path,
+                scene=scene
             )
             # instruct = g_data_item['programs'][0]['task_description'] if args.instruction else None   # deprecated
             instruct = g_data_item['programs']['task_description'] if args.instruction else None
             # Ensure the input length fit Codex max input tokens by shrinking the n_shots
-            few_shot_prompt = build_few_shot_prompt(examples, n_shots)
-            prompt = prefix + '\n\n' + few_shot_prompt + '\n\n' + construct_program_text(task_name=task, instruction=instruct, program=None) + '\n'
-            while len(tokenizer.tokenize(prompt)) >= max_prompt_tokens:
-                n_shots -= 1
-                assert n_shots >= 0
-                few_shot_prompt = build_few_shot_prompt(examples, n_shots)
-                prompt = prefix + '\n\n' + few_shot_prompt + '\n\n' + construct_program_text(task_name=task, instruction=instruct, program=None) + '\n'
-            assert len(tokenizer.tokenize(prompt)) < max_prompt_tokens
+            prompt, n_shots = prompt_builder.fit_few_shot(
+                prefix=prefix,
+                shots=[construct_program_text(_e['task'], None, _e['program']) for _e in examples[:n_shots]],
+                suffix=construct_program_text(task_name=task, instruction=instruct, program=None) + '\n',
+                max_prompt_tokens=max_prompt_tokens,
+                prefix_tokens=plan_generation_prompt_tokens(task_to_graph[task], args.plan_generation_prompt_path, prompt_builder, scene)
+            )
             g_dict[g_eid]['ori_data_item'].update({'plan_generation_prompt': prompt})   # @mengkang for debugging
             print(f"Process#{pid}: Building prompt for eid#{g_eid}")
             built_few_shot_prompts.append((g_eid, prompt))
-            if len(built_few_shot_prompts) < args.n_parallel_prompts:   # @mengkang we assert args.n_parallel_prompts==1
+            if len(built_few_shot_prompts) < args.n_parallel_prompts:   # batch n_parallel_prompts tasks in one request
+                continue
+            stream_checkers = build_stream_checkers(args, built_few_shot_prompts, dataset, task_to_graph)
+            if generator.max_in_flight > 1 or adaptive:     # send later, max_in_flight requests at the same time
+                pending_prompts.append(built_few_shot_prompts)
+                pending_checkers.append(stream_checkers)
+                built_few_shot_prompts = []
                 continue
 
-            # print(f"Process#{pid}: Prompts ready with {len(built_few_shot_prompts)} parallels. Run openai API.")
-            response_dict, usage = generator.generate_one_pass(
-                prompts=built_few_shot_prompts,
-                verbose=args.verbose
-            )
-            for eid, g_pairs in response_dict.items():
-                # g_pairs = sorted(g_pairs, key=lambda x: x[-1], reverse=True)
-                g_dict[eid]['generations'] = g_pairs
-            assert len(set([eid for eid, g_pairs in response_dict.items()])) == 1
-            g_dict[list(response_dict.keys())[0]]['usage'] = usage
+            run_generation(pid, args, generator, g_dict, built_few_shot_prompts, stream_checkers)
             built_few_shot_prompts = []
         except Exception as e:
             print(f"Process#{pid}: eid#{g_eid}, generation error: {e}")
             print(traceback.format_exc())
             # raise e
 
-    return g_dict
+    # the last batch may hold less than n_parallel_prompts prompts
+    if len(built_few_shot_prompts) > 0:
+        stream_checkers = build_stream_checkers(args, built_few_shot_prompts, dataset, task_to_graph)
+        if generator.max_in_flight > 1 or adaptive:
+            pending_prompts.append(built_few_shot_prompts)
+            pending_checkers.append(stream_checkers)
+        else:
+            run_generation(pid, args, generator, g_dict, built_few_shot_prompts, stream_checkers)
+    if len(pending_prompts) > 0 and adaptive:
+        run_adaptive_generation(pid, args, generator, g_dict, pending_prompts, pending_checkers)
+    elif len(pending_prompts) > 0:
+        print(f"Process#{pid}: Run openai API for {len(pending_prompts)} requests, {generator.max_in_flight} in flight.")
+        results = generator.generate_many(pending_prompts, verbose=args.verbose, stream_checkers_list=pending_checkers)
+        for p, r in zip(pending_prompts, results):
+            if isinstance(r, BaseException):
+                print(f"Process#{pid}: eid#{[_[0] for _ in p]}, generation error: {r}")
+                continue
+            update_generations(g_dict, *r)
+
+    return g_dict, generator.hedge_summary()
+
+
+def build_stream_checkers(args, built_few_shot_prompts, dataset, task_to_graph):
+    """
+    One PlanStreamChecker per prompt when streaming, samples with unknown actions or repeating
+    a finished plan of the same task are cut while they are generated.
+    """
+    if not args.stream:
+        return None
+    from utils.data_utils import PlanStreamChecker
+    return [PlanStreamChecker(task_to_graph[dataset[eid]['task']]) for eid, _ in built_few_shot_prompts]
+
+
+def load_task_to_idx(args, dataset, retrieval_dataset):
+    """
+    Retrieved examplar indices of every task, None for the fixed examplars.
+    With --retrieval_index they are computed (and saved to --example_idx_file if given) once before the workers start.
+    The saved file keeps a fingerprint of the tasks, the retrieval dataset, n_shots and the retrieval model,
+    it is only reused while they match. Without --retrieval_index, --example_idx_file is taken as given.
+    """
+    saved = None
+    if args.example_idx_file is not None and os.path.exists(args.example_idx_file):
+        saved = json.load(open(args.example_idx_file))
+    if args.retrieval_index is None:
+        # a file saved by load_task_to_idx keeps the mapping next to its fingerprint
+        return saved['task_to_idx'] if isinstance(saved, dict) and 'fingerprint' in saved else saved
+    from utils.retriever import build_task_to_idx, task_to_idx_fingerprint
+    tasks = [_['task'] for _ in dataset]
+    fingerprint = task_to_idx_fingerprint(tasks, retrieval_dataset, args.n_shots, args.retrieval_model)
+    if isinstance(saved, dict) and saved.get('fingerprint', None) == fingerprint:
+        return saved['task_to_idx']
+    if saved is not None:
+        print(f"{args.example_idx_file} was built for other tasks, examplars or retrieval settings, recomputing.")
+    task_to_idx = build_task_to_idx(
+        tasks=tasks,
+        retrieval_dataset=retrieval_dataset,
+        index_path=args.retrieval_index,
+        topk=args.n_shots,
+        model_name=args.retrieval_model
+    )
+    if args.example_idx_file is not None:
+        json.dump({'fingerprint': fingerprint, 'task_to_idx': task_to_idx}, open(args.example_idx_file, 'w', encoding='utf'), indent=4)
+    return task_to_idx
+
+
+def run_generation(pid, args, generator, g_dict, built_few_shot_prompts, stream_checkers=None):
+    try:
+        # print(f"Process#{pid}: Prompts ready with {len(built_few_shot_prompts)} parallels. Run openai API.")
+        response_dict, usage = generator.generate_one_pass(
+            prompts=built_few_shot_prompts,
+            verbose=args.verbose,
+            stream_checkers=stream_checkers
+        )
+        update_generations(g_dict, response_dict, usage)
+    except Exception as e:
+        print(f"Process#{pid}: eid#{[_[0] for _ in built_few_shot_prompts]}, generation error: {e}")
+        print(traceback.format_exc())
+
+
+def run_adaptive_generation(pid, args, generator, g_dict, pending_prompts, pending_checkers):
+    """
+    Sample in rounds: min_sampling_n samples per task first, then sampling_round_n more while the last round
+    added at least saturation_threshold new distinct plans (or Deciding_Tree nodes), sampling_n samples at most.
+    With max_tokens_per_new_plan a task also stops once a round spent more prompt + completion tokens than that
+    per new plan.
+    Only used on backends reusing the prompt prefix: all rounds of a request run back to back, so its prompt is
+    still in the prefix cache and every later round only encodes the prompts of the tasks that dropped out.
+    """
+    for prompts, checkers in zip(pending_prompts, pending_checkers):
+        trackers = {eid: PlanSetTracker(args.saturation_measure) for eid, _ in prompts}
+        n_drawn = 0
+        while len(prompts) > 0 and n_drawn < args.sampling_n:
+            cur_n = min(args.min_sampling_n if n_drawn == 0 else args.sampling_round_n, args.sampling_n - n_drawn)
+            for c in checkers or []:
+                c.new_request()
+            print(f"Process#{pid}: eid#{[_[0] for _ in prompts]}, sampling round with {cur_n} samples.")
+            r = generator.generate_many([prompts], verbose=args.verbose, stream_checkers_list=[checkers],
+                                        n=cur_n, sample_offset=n_drawn)[0]
+            if isinstance(r, BaseException):
+                print(f"Process#{pid}: eid#{[_[0] for _ in prompts]}, generation error: {r}")
+                break
+            update_generations(g_dict, *r, extend=True)
+            keep = []
+            for idx, (eid, _) in enumerate(prompts):
+                g_dict[eid]['n_samples'] = n_drawn + cur_n
+                n_new = trackers[eid].add([text for text, _ in r[0].get(eid, [])])
+                round_tokens = r[1]['per_eid'].get(eid, {}).get('total_tokens', 0)
+                too_costly = args.max_tokens_per_new_plan > 0 and round_tokens > args.max_tokens_per_new_plan * n_new
+                if n_drawn == 0 or (n_new >= args.saturation_threshold and not too_costly):
+                    keep.append(idx)
+                else:
+                    print(f"Process#{pid}: eid#{eid} saturated after {n_drawn + cur_n} samples.")
+            prompts = [prompts[i] for i in keep]
+            checkers = None if checkers is None else [checkers[i] for i in keep]
+            n_drawn += cur_n
+
+
+def update_generations(g_dict, response_dict, usage, extend=False):
+    # every eid of the request, a task whose samples were all dropped while streaming gets an empty generation list
+    for eid in usage['per_eid']:
+        g_pairs = response_dict.get(eid, [])
+        # g_pairs = sorted(g_pairs, key=lambda x: x[-1], reverse=True)
+        if extend and 'usage' in g_dict[eid]:  # a later sampling round of the same task
+            g_dict[eid]['generations'] += g_pairs
+            g_dict[eid]['usage'] = {k: v + usage['per_eid'][eid].get(k, 0) for k, v in g_dict[eid]['usage'].items()}
+            continue
+        g_dict[eid]['generations'] = g_pairs
+        g_dict[eid]['usage'] = usage['per_eid'][eid]
 
 
 '''
@@ -125,14 +266,14 @@ def annotate_multi_process_run(args):
     dataset = json.load(open(args.dataset, 'r', encoding='utf'))
     task_to_graph = json.load(open(args.task_to_graph, 'r', encoding='utf'))
     retrieval_dataset = json.load(open(args.retrieval_dataset))
-    task_to_idx = json.load(open(args.example_idx_file)) if args.example_idx_file is not None else None
+    task_to_idx = load_task_to_idx(args, dataset, retrieval_dataset)
     print("Number of samples in the dataset:", len(dataset))
-    # Load openai keys and split
+    # Load openai keys, all processes share one pool with per-key rate limits
     with open(args.api_keys_file, 'r') as f:
-        keys = [line.strip() for line in f.readlines()]
-    keys_process = [[''] for _ in range(args.n_processes)]
-    for _, k in enumerate(keys): keys_process[int(_)%args.n_processes].append(k)
-    keys_process = [_[1:] for _ in keys_process]
+        keys = [line.strip() for line in f.readlines() if line.strip() != '']
+    manager = KeyPoolManager()
+    manager.start()
+    key_pool = KeyPool(keys, rpm=args.key_rpm, tpm=args.key_tpm, manager=manager)
     # Split Dataset
     generate_eids = list(range(len(dataset)))
     generate_eids_group = [[] for _ in range(args.n_processes)]
@@ -141,11 +282,13 @@ def annotate_multi_process_run(args):
     print('\n******* Annotating *******')
     g_dict = dict()
     worker_results = []
-    pool = multiprocessing.Pool(processes=args.n_processes)
+    # simulator resources are parsed here once, forked workers share them (spawned workers load them in the initializer)
+    preload_resources()
+    pool = multiprocessing.Pool(processes=args.n_processes, initializer=preload_resources)
     for pid in range(args.n_processes):
         from transformers import AutoTokenizer
         tokenizer = AutoTokenizer.from_pretrained(pretrained_model_name_or_path=os.path.join(ROOT_DIR, "utils", "gpt2"))
-        generator = Generator(args, keys=keys_process[pid], tokenizer=tokenizer)
+        generator = Generator(args, keys=key_pool, tokenizer=tokenizer)
         worker_results.append(pool.apply_async(worker_annotate, args=(
             pid,
             args,
@@ -159,11 +302,17 @@ def annotate_multi_process_run(args):
         )))
 
     # Merge annotation results
+    hedge_stats_list = []
     for r in worker_results:
-        worker_g_dict = r.get()
+        worker_g_dict, hedge_stats = r.get()
+        hedge_stats_list.append(hedge_stats)
         g_dict.update(worker_g_dict)
+    if args.hedge_percentile > 0:   # tokens of the duplicate requests, next to the results
+        hedge_stats = save_hedge_stats(os.path.join(args.save_dir, args.plan_generation_result_file[:-5] + '_hedging.json'), hedge_stats_list)
+        print(f"Hedging {hedge_stats}")
     pool.close()
     pool.join()
+    manager.shutdown()
     print(f"Elapsed time: {time.time() - start_time}")
     return g_dict
 
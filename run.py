@@ -13,7 +13,10 @@ plan_generation_prompt_path = "./prompt/plan_generation_prompt.txt"
 
 
 engine = 'text-davinci-003'
+backend = 'openai'  # 'local' runs a causal LM on CPU, see README
 n_processes = 5
+cache_path = '../dataplace/api_cache.sqlite'   # reruns reuse api responses, see generation/cache.py
+env_prompt_cache = '../dataplace/env_prompt_cache.jsonl'    # scene prompts rendered once, see utils/env_utils.py
 
 
 def plan_generation(data_dir, save_dir, sampling_n, postfix=''):
@@ -30,6 +33,8 @@ def plan_generation(data_dir, save_dir, sampling_n, postfix=''):
     _ = dataset_name[:-5]
     plan_generation_prompt_path = './prompt/plan_generation_prompt.txt'
     plan_generation_result_file = f'{engine}_{sampling_n}_{postfix}.json'
+    n_parallel_prompts = 4  # tasks sent in one completion request
+    min_sampling_n = 10 if backend == 'local' else 0    # 10 samples first, then rounds until no new plans
     dataset = f'{data_dir}/{dataset_name}'
     task_to_graph = f'{data_dir}/task_to_graph.json'
     os.system(fr"""python {ROOT_DIR}/plan_generation.py    \
@@ -37,7 +42,8 @@ def plan_generation(data_dir, save_dir, sampling_n, postfix=''):
                 --top_p {topp}  \
                 --max_generation_tokens {max_gen}   \
                 --sampling_n {sampling_n}  \
-                --n_parallel_prompts    1   \
+                --n_parallel_prompts    {n_parallel_prompts}   \
+                --min_sampling_n    {min_sampling_n}   \
                 --plan_generation_result_file   {plan_generation_result_file}   \
                 --n_processes {n_processes} \
                 --n_shots   {n_shots}       \
@@ -46,7 +52,10 @@ def plan_generation(data_dir, save_dir, sampling_n, postfix=''):
                 --save_dir {save_dir}   \
                 --plan_generation_prompt_path   {plan_generation_prompt_path}   \
                 --task_to_graph {task_to_graph} \
-                --engine    {engine}
+                --engine    {engine}    \
+                --backend   {backend}   \
+                --cache_path    {cache_path}    \
+                --env_prompt_cache  {env_prompt_cache}
                 """)
     # return os.path.join(save_dir, plan_generation_result_file)
     return plan_generation_result_file
@@ -70,6 +79,7 @@ def grounded_deciding(plan_generation_result_file, data_dir, save_dir, retry_tim
     temp = 0.7
     topp = 1.00
     sampling_n = 20
+    vote_batch_size = 5 if backend == 'local' else 0    # votes drawn 5 at a time until the majority is decided
     max_gen = 50
     # n_processes = 5
     grounded_deciding_prompt_path = './prompt/grounded_deciding_prompt.txt'
@@ -84,6 +94,7 @@ def grounded_deciding(plan_generation_result_file, data_dir, save_dir, retry_tim
                 --top_p {topp}  \
                 --max_generation_tokens {max_gen}   \
                 --sampling_n {sampling_n}  \
+                --vote_batch_size {vote_batch_size}  \
                 --n_parallel_prompts    1   \
                 --grounded_deciding_result_file   {grounded_deciding_result_file}   \
                 --n_processes {n_processes} \
@@ -93,7 +104,9 @@ def grounded_deciding(plan_generation_result_file, data_dir, save_dir, retry_tim
                 --grounded_deciding_prompt_path   {grounded_deciding_prompt_path}   \
                 --task_to_graph {task_to_graph} \
                 --retry_times   {retry_times}    \
-                --engine    {engine}
+                --engine    {engine}    \
+                --backend   {backend}   \
+                --cache_path    {cache_path}
                 """)
 
 
@@ -0,0 +1,58 @@
+import os
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+
+from generation.cache import ResponseCache
+
+
+def claim_as(path, key, pid):
+    # the claim row another process writes before calling the api
+    cache = ResponseCache(path)
+    cache._get_conn()
+    conn = sqlite3.connect(path)
+    conn.execute('INSERT INTO inflight (key, pid, started) VALUES (?, ?, ?)', (key, pid, time.time()))
+    conn.commit()
+    conn.close()
+    return cache
+
+
+def test_threads_share_one_call(tmp_path):
+    cache = ResponseCache(str(tmp_path / 'cache.db'))
+    calls = []
+
+    def fn():
+        calls.append(1)
+        time.sleep(0.2)
+        return {'choices': []}
+    threads = [threading.Thread(target=cache.get_or_compute, args=('key', fn)) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(calls) == 1
+    assert cache.get('key') == {'choices': []}
+
+
+def test_waits_for_the_response_of_another_process(tmp_path):
+    path = str(tmp_path / 'cache.db')
+    other = claim_as(path, 'key', os.getppid())     # a live process that is not this one
+
+    def answer():
+        time.sleep(0.3)
+        other.put('key', {'choices': ['from the other process']})
+    threading.Thread(target=answer).start()
+    cache = ResponseCache(path, poll_interval=0.05)
+    assert cache.get_or_compute('key', lambda: {'choices': ['called again']}) == {'choices': ['from the other process']}
+
+
+def test_claim_of_a_dead_process_is_taken_over(tmp_path):
+    path = str(tmp_path / 'cache.db')
+    dead = subprocess.Popen([sys.executable, '-c', 'pass'])
+    dead.wait()
+    claim_as(path, 'key', dead.pid)
+    cache = ResponseCache(path, poll_interval=0.05)
+    assert cache.get_or_compute('key', lambda: {'choices': ['computed']}) == {'choices': ['computed']}
+    assert cache._get_conn().execute('SELECT COUNT(*) FROM inflight').fetchone()[0] == 0
@@ -0,0 +1,44 @@
+import multiprocessing
+import time
+
+import pytest
+
+from generation.key_pool import KeyPool, KeyPoolManager, RequestFailed
+
+
+class RateLimitError(Exception):
+    pass
+
+
+def acquire_twice(key_pool):
+    return [key_pool.acquire() for _ in range(2)]
+
+
+def test_shared_pool_draws_from_the_same_buckets():
+    manager = KeyPoolManager()
+    manager.start()
+    try:
+        key_pool = KeyPool(['a', 'b'], rpm=3, manager=manager)
+        with multiprocessing.Pool(2) as pool:
+            keys = sum(pool.map(acquire_twice, [key_pool, key_pool]), [])
+        assert len(keys) == 4 and set(keys) <= {'a', 'b'}
+        # 6 requests per minute in total, 4 are taken by the workers
+        assert key_pool.try_acquire()[0] is not None
+        assert key_pool.try_acquire()[0] is not None
+        assert key_pool.try_acquire()[0] is None
+    finally:
+        manager.shutdown()
+
+
+def test_throttled_keys_cool_down():
+    key_pool = KeyPool(['a', 'b'])
+    assert key_pool.report_error('a', RateLimitError(), 0) == (True, 0.0)
+    assert key_pool.try_acquire() == ('b', 0)
+    assert key_pool.try_acquire(exclude=('b',))[0] is None
+
+
+def test_deadline_while_waiting_for_a_key():
+    key_pool = KeyPool(['a'], rpm=1)
+    key_pool.acquire()
+    with pytest.raises(RequestFailed, match='Timed out waiting for an api key'):
+        key_pool.acquire(deadline=time.time() + 1)
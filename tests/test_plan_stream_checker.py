@@ -0,0 +1,92 @@
+import importlib
+import sys
+import types
+
+import pytest
+
+GRAPH_DICT = {
+    'nodes': [
+        {'id': 1, 'class_name': 'kitchen', 'category': 'Rooms', 'states': []},
+        {'id': 2, 'class_name': 'cup', 'category': 'Props', 'states': []},
+        {'id': 3, 'class_name': 'sink', 'category': 'Furniture', 'states': []},
+    ],
+    'edges': []
+}
+PLAN = '[WALK] <kitchen> (1)\n[GRAB] <cup> (2)'
+LONGER_PLAN = PLAN + '\n[PUTBACK] <cup> (2) <sink> (3)'
+
+
+def check_action_valid(action_str, graph_dict):
+    # stands in for the simulator's script parser: only [FLY...] actions are unknown
+    if action_str.startswith('[FLY'):
+        return False, 'Unknown action'
+    return True, ''
+
+
+@pytest.fixture
+def data_utils(monkeypatch):
+    """
+    utils.data_utils with the simulator modules it imports stubbed, and check_action_valid replaced,
+    so the checker logic runs without the simulator.
+    """
+    scripts = types.ModuleType('simulation.evolving_graph.scripts')
+    scripts.parse_script_line = None
+    retriever = types.ModuleType('sampling_grounding_deciding.utils.retriever')
+    retriever.Retriever = None
+    for name, module in [('simulation', types.ModuleType('simulation')),
+                         ('simulation.evolving_graph', types.ModuleType('simulation.evolving_graph')),
+                         ('simulation.evolving_graph.scripts', scripts),
+                         ('sampling_grounding_deciding', types.ModuleType('sampling_grounding_deciding')),
+                         ('sampling_grounding_deciding.utils', types.ModuleType('sampling_grounding_deciding.utils')),
+                         ('sampling_grounding_deciding.utils.retriever', retriever)]:
+        monkeypatch.setitem(sys.modules, name, module)
+    monkeypatch.delitem(sys.modules, 'utils.data_utils', raising=False)
+    module = importlib.import_module('utils.data_utils')
+    monkeypatch.setattr(module, 'check_action_valid', check_action_valid)
+    yield module
+    sys.modules.pop('utils.data_utils', None)
+
+
+def test_prefix_of_completed_plan_is_not_cut(data_utils):
+    checker = data_utils.PlanStreamChecker(GRAPH_DICT)
+    assert not checker(0, PLAN, True)
+    # another sample passes through the completed plan on its way to a longer one
+    assert not checker(1, PLAN + '\n', False)
+    assert not checker(1, PLAN + '\n[PUT', False)
+    assert not checker(1, LONGER_PLAN, True)
+    assert checker.resolve(1) is None
+    assert 1 not in checker.cut
+
+
+def test_duplicate_is_cut_once_the_plan_ends(data_utils):
+    checker = data_utils.PlanStreamChecker(GRAPH_DICT)
+    assert not checker(0, PLAN, True)
+    assert not checker(1, PLAN + '\n', False)
+    # a blank line after the completed plan: the sample repeats it and would only go on with another plan
+    assert checker(1, PLAN + '\n\n', False)
+    assert checker.resolve(1) == PLAN
+
+
+def test_plan_not_completed_elsewhere_is_not_cut(data_utils):
+    checker = data_utils.PlanStreamChecker(GRAPH_DICT)
+    assert not checker(0, LONGER_PLAN, True)
+    assert not checker(1, PLAN + '\n\n[WALK]', False)
+    # a sample that stops on a completed plan is a duplicate too, but there is nothing left to cut
+    assert not checker(2, LONGER_PLAN, True)
+    assert checker.resolve(1) is None and checker.resolve(2) is None
+
+
+def test_completed_plans_are_kept_across_requests(data_utils):
+    checker = data_utils.PlanStreamChecker(GRAPH_DICT)
+    assert not checker(0, PLAN, True)
+    checker.new_request()
+    assert checker(0, PLAN + '\n\n', False)
+    assert checker.resolve(0) == PLAN
+
+
+def test_unknown_action_is_cut_and_dropped(data_utils):
+    checker = data_utils.PlanStreamChecker(GRAPH_DICT)
+    assert checker(0, '[WALK] <kitchen> (1)\n[FLYTO] <cup> (2)\n', False)
+    assert 0 in checker.cut and checker.resolve(0) is None
+    # the unfinished last line is only checked once it is complete
+    assert not checker(1, '[WALK] <kitchen> (1)\n[FLYTO] <cu', False)
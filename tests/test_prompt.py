@@ -0,0 +1,43 @@
+import os
+
+from generation import prompt as prompt_module
+from generation.prompt import PromptBuilder, get_prompt_file
+
+
+class CountingTokenizer:
+    name_or_path = 'words'
+
+    def __init__(self):
+        self.calls = 0
+
+    def tokenize(self, text):
+        self.calls += 1
+        return text.split()
+
+
+def test_prompt_file_token_count_is_kept_until_the_file_changes(tmp_path, monkeypatch):
+    path = str(tmp_path / 'prompt.txt')
+    with open(path, 'w') as f:
+        f.write('one two three')
+    tokenizer = CountingTokenizer()
+    prompt_file = get_prompt_file(path)
+    assert prompt_file.count_tokens(tokenizer) == 3
+    assert get_prompt_file(path).count_tokens(tokenizer) == 3
+    assert tokenizer.calls == 1
+
+    with open(path, 'w') as f:
+        f.write('one two three four')
+    os.utime(path, (prompt_file.mtime + 10, prompt_file.mtime + 10))
+    # not checked again before the interval is over
+    assert get_prompt_file(path) is prompt_file
+    monkeypatch.setattr(prompt_module, 'PROMPT_FILE_CHECK_INTERVAL', 0)
+    assert get_prompt_file(path).text == 'one two three four'
+    assert get_prompt_file(path).count_tokens(tokenizer) == 4
+    assert tokenizer.calls == 2
+
+
+def test_joins_exactly():
+    assert PromptBuilder.joins_exactly('prefix.', '\nTask: x')
+    assert PromptBuilder.joins_exactly('Task: x\n', 'Task: y')
+    assert not PromptBuilder.joins_exactly('prefix \n', '\nTask: x')
+    assert not PromptBuilder.joins_exactly('prefix ', 'Task: x')
@@ -0,0 +1,76 @@
+import copy
+
+from utils.state_history import GraphStateList, state_extras, restore_state_extras
+
+
+class FakeState:
+    """
+    Stands in for an EnvironmentState: a graph dict plus the fields the graph dict does not keep.
+    """
+
+    def __init__(self, graph_dict):
+        self.graph_dict = copy.deepcopy(graph_dict)
+        self._script_objects = {}
+        self.executor_data = {}
+
+    def to_dict(self):
+        return copy.deepcopy(self.graph_dict)
+
+
+def node(node_id, *states):
+    return {'id': node_id, 'class_name': f'obj{node_id}', 'category': 'Props', 'states': list(states)}
+
+
+def step(state, node_id, new_state, script_object):
+    # an action changes one node and binds the script object it was given
+    new = FakeState(state.graph_dict)
+    new._script_objects = dict(state._script_objects)
+    new.executor_data = copy.deepcopy(state.executor_data)
+    new.graph_dict['nodes'] = [node(node_id, new_state) if n['id'] == node_id else n for n in new.graph_dict['nodes']]
+    new._script_objects[script_object] = node_id
+    new.executor_data.setdefault('actions', []).append(script_object)
+    return new
+
+
+def test_backtracking_restores_the_fields_missing_from_the_graph_dict():
+    state = FakeState({'nodes': [node(1, 'CLOSED'), node(2, 'OFF')], 'edges': []})
+    graph_state_list, state_extras_list = GraphStateList(), []
+    graph_state_list.append(state.to_dict())
+    state_extras_list.append(state_extras(state))
+    states = [state]
+    for node_id, new_state, script_object in [(1, 'OPEN', ('obj1', 1)), (2, 'ON', ('obj2', 2)), (1, 'CLOSED', ('obj1', 1))]:
+        state = step(state, node_id, new_state, script_object)
+        graph_state_list.append(state.to_dict())
+        state_extras_list.append(state_extras(state, state_extras_list[-1]))
+        states.append(state)
+    state.executor_data['actions'].append('modified in place after the layer was recorded')
+
+    t = 1
+    graph_state_list.truncate(t + 1)
+    state_extras_list = state_extras_list[:t + 1]
+    # as grounded_exec does: a fresh state from the graph dict of layer t, then its extras
+    rebuilt = FakeState(graph_state_list[t])
+    assert rebuilt._script_objects == {}
+    restore_state_extras(rebuilt, state_extras_list[t])
+    assert rebuilt.to_dict() == states[t].to_dict()
+    assert rebuilt._script_objects == states[t]._script_objects == {('obj1', 1): 1}
+    assert rebuilt.executor_data == {'actions': [('obj1', 1)]}
+
+    # the restored fields are copies, a second backtrack to the same layer gets them unchanged
+    rebuilt.executor_data['actions'].append(('obj2', 2))
+    again = restore_state_extras(FakeState(graph_state_list[t]), state_extras_list[t])
+    assert again.executor_data == {'actions': [('obj1', 1)]}
+
+
+def test_unchanged_extras_are_shared_with_the_previous_layer():
+    state = FakeState({'nodes': [node(1, 'CLOSED'), node(2, 'OFF')], 'edges': []})
+    state.executor_data['visited'] = {'kitchen': [1]}
+    first = state_extras(state)
+    state = step(state, 1, 'OPEN', ('obj1', 1))
+    second = state_extras(state, first)
+    assert second['executor_data']['visited'] is first['executor_data']['visited']
+    assert second['executor_data']['actions'] == [('obj1', 1)]
+    third = state_extras(step(state, 1, 'OPEN', ('obj1', 1)), second)
+    assert third['_script_objects'] is second['_script_objects']
+    assert third['executor_data']['actions'] == [('obj1', 1), ('obj1', 1)]
+    assert second['executor_data']['actions'] == [('obj1', 1)]
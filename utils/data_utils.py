@@ -139,6 +139,67 @@ def clean_action_wprob(script_wprob, graph_dict):
     return new_script_str
 
 
+# streaming plan generation, samples are checked line by line while they are generated
+class PlanStreamChecker:
+    """
+    Cut a streamed sample as soon as one of its lines is an unknown action (clean_action would drop that line)
+    or as soon as it has repeated a plan that another sample already completed.
+    A sample repeats a completed plan once its finished lines equal that plan and a blank line follows them, the
+    plan ends there (a sample stopping there is complete anyway). A sample whose next line goes on is not cut, it
+    may extend the completed plan into a longer one (a sample heading to "a\nb\nc" passes through "a\nb").
+    A sample cut as a duplicate is resolved to the completed plan, a sample cut for an unknown action is dropped.
+    """
+    def __init__(self, graph_dict):
+        self.graph_dict = graph_dict
+        self.complete_plans = set()
+        self.n_checked_lines = {}
+        self.cut = {}   # index -> plan text (duplicate) / None (invalid)
+
+    @staticmethod
+    def plan_lines(text, finished):
+        """
+        The finished action lines of text up to the first blank line, and whether the plan ends there.
+        """
+        all_lines = [_.strip() for _ in text.split('\n')]
+        # the last line may be incomplete
+        plan = []
+        for line in (all_lines if finished else all_lines[:-1]):
+            if line == '':
+                if len(plan) > 0:
+                    return tuple(plan), True
+                continue
+            plan.append(line)
+        return tuple(plan), finished
+
+    def __call__(self, index, text, finished):
+        plan, ended = self.plan_lines(text, finished)
+        new_lines = plan[self.n_checked_lines.get(index, 0):]
+        self.n_checked_lines[index] = len(plan)
+        for action_str in new_lines:
+            valid, info = check_action_valid(action_str, self.graph_dict)
+            if 'unknown action' in info.lower():
+                self.cut[index] = None
+                return True
+        if not ended or len(plan) == 0:
+            return False
+        if finished:
+            self.complete_plans.add(plan)
+            return False
+        # the plan is over but the sample goes on after a blank line, keep the plan and stop the sample
+        if plan in self.complete_plans:
+            self.cut[index] = '\n'.join(plan)
+            return True
+        return False
+
+    def resolve(self, index):
+        return self.cut.get(index, None)
+
+    def new_request(self):
+        # choice indices restart with every request, completed plans are kept
+        self.n_checked_lines = {}
+        self.cut = {}
+
+
 def post_process_of_generation(generation_result, task_to_graph, obj_translate=False):
     # data = json.load(open(generation_file))
     data = generation_result
@@ -147,7 +208,7 @@ def post_process_of_generation(generation_result, task_to_graph, obj_translate=F
         task = item['ori_data_item']['task']
         graph_dict = task_to_graph[task]
         if obj_translate:
-            obj_list = list(set([_['class_name'] for _ in graph_dict['nodes']]))
+            obj_list = list(dict.fromkeys([_['class_name'] for _ in graph_dict['nodes']]))
             retriver = Retriever(cuda='cuda:1')
             ot = Obj_Translator(retriever=retriver, obj_list=obj_list)
         tokens = item['usage']['total_tokens']
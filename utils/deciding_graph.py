@@ -18,6 +18,7 @@ class Deciding_Node:
         self.node_path.reverse()
         self.node_color = node_color
         self.edge_color = edge_color
+        self.choice_probs = {}  # action_str of a son -> probability, from the last decision made at this node
         self.reset()
 
     def reset(self):
@@ -56,6 +57,22 @@ class Deciding_Node:
     def get_valid_choices(self):
         return [_.action_str for _ in filter(lambda x:x.status, self.son_list)]
 
+    def set_choice_probs(self, choice_probs):
+        self.choice_probs = choice_probs
+
+    def get_fallback_choice(self, min_prob=0.0):
+        """
+        The most probable valid choice of the last decision, with its probability renormalized over the valid choices.
+        None if no valid choice got any probability or the best one has less than min_prob.
+        """
+        valid = [_ for _ in self.get_valid_choices() if self.choice_probs.get(_, 0) > 0]
+        if len(valid) == 0:
+            return None
+        best = max(valid, key=lambda x:self.choice_probs[x])
+        if self.choice_probs[best] / sum([self.choice_probs[_] for _ in valid]) < min_prob:
+            return None
+        return best
+
     def get_valid_choices_sequence(self):   # TODO sequence implementation version (w/o beamsearch window size)
         sub_son_list = list(filter(lambda x:x.status, self.son_list))
         res = []
@@ -136,6 +153,30 @@ def visualize_tree(root_node: Deciding_Node):
     return dot
 
 
+class PlanSetTracker:
+    """
+    Distinct plans (measure='plans') or Deciding_Tree nodes (measure='nodes', i.e. distinct plan prefixes)
+    among the plans seen so far, used to stop sampling once new samples stop adding branches.
+    """
+    def __init__(self, measure='plans'):
+        assert measure in ['plans', 'nodes']
+        self.measure = measure
+        self.items = set()
+
+    def add(self, plans):
+        """
+        Add plan texts (one action per line), return the number of new distinct plans / nodes.
+        """
+        n_items = len(self.items)
+        for plan in plans:
+            lines = tuple([' '.join(_.split()).lower() for _ in plan.split('\n') if _.strip() != ''])
+            if self.measure == 'plans':
+                self.items.add(lines)
+            else:
+                self.items.update([lines[:i] for i in range(1, len(lines) + 1)])
+        return len(self.items) - n_items
+
+
 class Deciding_Tree:
     def __init__(self, script_str_list, task):
         self.script_str_list = copy.deepcopy(script_str_list)
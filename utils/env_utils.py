@@ -2,87 +2,189 @@ import copy
 import json
 import os
 import random
+import re
 import sys
+import hashlib
+import threading
+try:
+    import fcntl
+except ImportError:     # windows, the env prompt cache file is then appended to without a lock
+    fcntl = None
 ROOT_DIR = os.path.join(os.path.dirname(__file__))
 # print(ROOT_DIR)
 sys.path.append(f'{ROOT_DIR}/../../simulation')
 sys.path.append(f'{ROOT_DIR}/../../')
 import evolving_graph.utils as utils
 from evolving_graph.environment import EnvironmentGraph, EnvironmentState, Relation, State
+from evolving_graph.resources import get_resource
+from generation.prompt import get_prompt_file, PromptBuilder, PromptLayout
 # import simulation.evolving_graph.utils as utils
 # from simulation.evolving_graph.environment import EnvironmentGraph, EnvironmentState, Relation, State
 # from simulation.evolving_graph.execution import Relation, State
 
 
+class SpatialIndex(object):
+    """
+    Containment and adjacency index of a scene graph, answers the partial observation of the character
+    in time proportional to what it sees instead of scanning every edge.
+    update() takes the graph dict of a later state and applies the edges that changed, which still scans the graph.
+    apply_delta() follows a GraphStateList delta (see utils/state_history.py) in time proportional to its size,
+    so an index kept next to the states of an execution costs nothing per step beyond the changes.
+    Edges are ordered by position, the position in the last graph dict given to update() or, for edges added by
+    deltas, after every edge already indexed (the order of graph dicts that append new edges).
+    """
+
+    def __init__(self, graph_dict=None):
+        self.id2node = {}
+        self.room_ids = []
+        self.character_ids = []
+        self.edges = {}         # (from_id, relation_type, to_id) -> (position in the graph, edge)
+        self.edges_of = {}      # node id -> keys of the edges from or to it
+        self.inside_of = {}     # node id -> {container id: None}
+        self.is_inside = {}     # container id -> {node id: None}
+        self._next_position = 0
+        if graph_dict is not None:
+            self.update(graph_dict)
+
+    @staticmethod
+    def edge_key(edge):
+        return edge['from_id'], edge['relation_type'], edge['to_id']
+
+    def _add_edge(self, key, position, edge):
+        from_id, relation, to_id = key
+        self.edges[key] = (position, edge)
+        self.edges_of.setdefault(from_id, set()).add(key)
+        self.edges_of.setdefault(to_id, set()).add(key)
+        if relation == 'INSIDE' and from_id != to_id:
+            self.inside_of.setdefault(from_id, {})[to_id] = None
+            self.is_inside.setdefault(to_id, {})[from_id] = None
+
+    def _remove_edge(self, key):
+        from_id, relation, to_id = key
+        del self.edges[key]
+        for node_id in {from_id, to_id}:
+            self.edges_of[node_id].discard(key)
+            if len(self.edges_of[node_id]) == 0:
+                del self.edges_of[node_id]
+        if relation == 'INSIDE' and from_id != to_id:
+            for d, k, v in [(self.inside_of, from_id, to_id), (self.is_inside, to_id, from_id)]:
+                del d[k][v]
+                if len(d[k]) == 0:
+                    del d[k]
+
+    def update(self, graph_dict):
+        self.id2node = {node['id']: node for node in graph_dict['nodes']}
+        self.room_ids = [node['id'] for node in graph_dict['nodes'] if node['category'] == 'Rooms']
+        self.character_ids = [node['id'] for node in graph_dict['nodes'] if node['class_name'] == 'character']
+        # duplicated edges are kept once
+        edges = {}
+        for position, edge in enumerate(graph_dict['edges']):
+            edges.setdefault(self.edge_key(edge), (position, edge))
+        for key in [k for k in self.edges if k not in edges]:
+            self._remove_edge(key)
+        for key, (position, edge) in edges.items():
+            if key not in self.edges:
+                self._add_edge(key, position, edge)
+            else:   # only the position in the graph may change, it orders the observation as a full scan would
+                self.edges[key] = (position, edge)
+        self._next_position = len(graph_dict['edges'])
+        return self
+
+    def _set_node(self, node_id, before, after):
+        if after is None:
+            del self.id2node[node_id]
+        else:
+            self.id2node[node_id] = after
+        if before is None or after is None:     # a node added or removed, the character or room lists may change
+            node = before if after is None else after
+            for ids, member in [(self.room_ids, node['category'] == 'Rooms'), (self.character_ids, node['class_name'] == 'character')]:
+                if member and after is None:
+                    ids.remove(node_id)
+                elif member:
+                    ids.append(node_id)
+
+    def apply_delta(self, delta, undo=False):
+        """
+        Apply a delta of GraphStateList (undo it with undo=True) to the indexed graph, None is the empty delta.
+        """
+        if delta is None:
+            return self
+        for node_id, (before, after) in delta['nodes'].items():
+            self._set_node(node_id, *((after, before) if undo else (before, after)))
+        added, removed = (delta['removed_edges'], delta['added_edges']) if undo else (delta['added_edges'], delta['removed_edges'])
+        for key in removed:
+            self._remove_edge(key)
+        for key, edge in added.items():
+            self._add_edge(key, self._next_position, edge)
+            self._next_position += 1
+        return self
+
+    def container(self, node_id):
+        # the container of the last inside edge, as in the full scan
+        containers = self.inside_of.get(node_id, None)
+        return max(containers, key=lambda c: self.edges[(node_id, 'INSIDE', c)][0]) if containers else None
+
+    def _sorted_edges(self, keys):
+        return [self.edges[k][1] for k in sorted(keys, key=lambda k: self.edges[k][0])]
+
+    def contents(self, container_id):
+        # objects directly inside container_id, in the order of their edges
+        return sorted(self.is_inside.get(container_id, {}), key=lambda node_id: self.edges[(node_id, 'INSIDE', container_id)][0])
+
+    def observable_ids(self):
+        """
+        Ids of the nodes seen by the character: the objects in its room (recursively) that are not directly inside
+        a closed container, then the rooms and the objects held by the character.
+        """
+        # Assumption: inside is not transitive. For every object, only the closest inside relation is recorded
+        assert len(self.character_ids) == 1
+        character_id = self.character_ids[0]
+        room_id = self.container(character_id)
+        object_in_room_ids = self.contents(room_id)
+        # Some object are not directly in room, but we want to add them
+        obj_id_set = set(object_in_room_ids)
+        curr_objects = object_in_room_ids
+        while len(curr_objects) > 0:
+            objects_inside = []
+            for curr_obj_id in curr_objects:
+                for obj_id in self.contents(curr_obj_id):
+                    if obj_id not in obj_id_set:
+                        obj_id_set.add(obj_id)
+                        objects_inside.append(obj_id)
+            object_in_room_ids = object_in_room_ids + objects_inside
+            curr_objects = objects_inside
+        room_id_set = set(self.room_ids)
+
+        def object_hidden(ido):
+            container_id = self.container(ido)
+            return container_id not in room_id_set and 'CLOSED' in self.id2node[container_id]['states']
+        grabbed_keys = [k for k in self.edges_of.get(character_id, ()) if k[0] == character_id and 'HOLDS' in k[1]]
+        grabbed_ids = [k[2] for k in sorted(grabbed_keys, key=lambda k: self.edges[k][0])]
+        return [object_id for object_id in object_in_room_ids if not object_hidden(object_id)] + self.room_ids + grabbed_ids
+
+    def partial_observation(self, object_ids=None):
+        """
+        Observable nodes and the edges between them, only those of object_ids (and the edges touching them) if given.
+        """
+        observable_object_ids = self.observable_ids()
+        observable_set = set(observable_object_ids)
+        if object_ids is None:
+            selected = observable_set
+            nodes = [self.id2node[id_node] for id_node in observable_object_ids]
+        else:
+            selected = observable_set & set(object_ids)
+            nodes = [self.id2node[id_node] for id_node in observable_object_ids if id_node in selected]
+        keys = set()
+        for node_id in selected:
+            keys.update([k for k in self.edges_of.get(node_id, ()) if k[0] in observable_set and k[2] in observable_set])
+        return {'edges': self._sorted_edges(keys), 'nodes': nodes}
+
+
 # adapt from https://github.com/ShuangLI59/Pre-Trained-Language-Models-for-Interactive-Decision-Making
 def _mask_state(state):
-    # Assumption: inside is not transitive. For every object, only the closest inside relation is recorded
-    # print('self.character_n: {}, len:{}, char_index: {}'.format(self.character_n, len(self.character_n), char_index))
-    # print('%d agents: get partial observation of agent %d' % (len(self.character_n), char_index))
-    if isinstance(state, dict):
-        state = state
-    else:
+    if not isinstance(state, dict):
         state = state.to_dict()
-    character = [n for n in filter(lambda x:x['class_name'] == 'character', state['nodes'])]
-    assert len(character) == 1
-    character = character[0]
-    # find character
-    character_id = character['id']
-    id2node = {node['id']: node for node in state['nodes']}
-    inside_of, is_inside, edge_from = {}, {}, {}
-    grabbed_ids = []
-    for edge in state['edges']:
-
-        if edge['relation_type'] == 'INSIDE':
-            if edge['to_id'] == edge['from_id']:
-                continue
-            if edge['to_id'] not in is_inside.keys():
-                is_inside[edge['to_id']] = []
-
-            is_inside[edge['to_id']].append(edge['from_id'])
-            inside_of[edge['from_id']] = edge['to_id']
-
-
-        elif 'HOLDS' in edge['relation_type']:
-            if edge['from_id'] == character['id']:
-                grabbed_ids.append(edge['to_id'])
-
-
-    character_inside_ids = inside_of[character_id]
-    room_id = character_inside_ids
-
-
-    object_in_room_ids = is_inside[room_id]
-
-    # Some object are not directly in room, but we want to add them
-    curr_objects = list(object_in_room_ids)
-    obj_id_set = set(curr_objects)  # deduplicate
-    while len(curr_objects) > 0:
-        objects_inside = []
-        for curr_obj_id in curr_objects:
-            new_inside = is_inside[curr_obj_id] if curr_obj_id in is_inside.keys() else []
-            new_inside = list(filter(lambda x:x not in obj_id_set, new_inside))
-            objects_inside += new_inside
-            obj_id_set = obj_id_set | set(new_inside)
-        object_in_room_ids += list(objects_inside)
-        curr_objects = list(objects_inside)
-
-    # Only objects that are inside the room and not inside something closed
-    # this can be probably speed up if we can ensure that all objects are either closed or open
-    rooms = [n for n in filter(lambda x:x['category'] == 'Rooms', state['nodes'])]
-    rooms_ids = [n['id'] for n in rooms]
-    object_hidden = lambda ido: inside_of[ido] not in rooms_ids and 'CLOSED' in id2node[inside_of[ido]]['states']
-
-    observable_object_ids = [object_id for object_id in object_in_room_ids if not object_hidden(object_id)] + rooms_ids
-    observable_object_ids += grabbed_ids
-
-
-    partilly_observable_state = {
-        "edges": [edge for edge in state['edges'] if edge['from_id'] in observable_object_ids and edge['to_id'] in observable_object_ids],
-        "nodes": [id2node[id_node] for id_node in observable_object_ids]
-    }
-
-    return partilly_observable_state
+    return SpatialIndex(state).partial_observation()
 
 
 def get_object_id_list_from_script(script_lines):
@@ -160,7 +262,8 @@ def translate_sub_graph_to_text(graph_dict, observation):
                 room_obj_map[to_obj] = []
             room_obj_map[to_obj].append(from_obj)
         edge_text_list.append(f'{from_obj} is {rel_type} {to_obj}')
-    edge_text_list = list(set(edge_text_list))
+    # deduplicated in order, a set would order the lines by string hash, which changes with PYTHONHASHSEED
+    edge_text_list = list(dict.fromkeys(edge_text_list))
     for room, obj_list in room_obj_map.items():
         obj_str = ','.join(obj_list)
         edge_text_list.append(f'{obj_str} is inside {room}')
@@ -169,7 +272,7 @@ def translate_sub_graph_to_text(graph_dict, observation):
         class_name = node['class_name']
         state_text = ', '.join([_.lower() for _ in node['states']])
         node_text_list.append(f'{class_name} is {state_text}')
-    node_text_list = list(set(node_text_list))
+    node_text_list = list(dict.fromkeys(node_text_list))
     res = ''
     if len(node_text_list) > 0:
         res += '\n'.join(node_text_list)
@@ -178,47 +281,195 @@ def translate_sub_graph_to_text(graph_dict, observation):
     return res
 
 
+def observation_facts(graph_dict, observation):
+    """
+    Deduplicated facts of an observation, {text: ids of the objects it mentions} in the order of the observation.
+    One line per object state, edges of the same relation to the same object are grouped in one line
+    (so objects inside a room are listed once instead of edge by edge and again in a room summary).
+    """
+    id_to_node = {node['id']: node for node in graph_dict['nodes']}
+    facts = {}
+    for node in observation['nodes']:
+        if len(node['states']) == 0:
+            continue
+        state_text = ', '.join([_.lower() for _ in node['states']])
+        facts.setdefault(f"{node['class_name']} is {state_text}", set()).add(node['id'])
+    groups = {}     # (relation, to object) -> {from object: ids}
+    for _e in observation['edges']:
+        from_node, to_node = id_to_node[int(_e['from_id'])], id_to_node[int(_e['to_id'])]
+        rel_type = _e['relation_type'].lower()
+        if rel_type == 'close': rel_type = 'close to'
+        group = groups.setdefault((rel_type, to_node['class_name']), {})
+        group.setdefault(from_node['class_name'], set()).update([from_node['id'], to_node['id']])
+    for (rel_type, to_obj), from_objs in groups.items():
+        verb = 'is' if len(from_objs) == 1 else 'are'
+        facts.setdefault(f"{', '.join(from_objs)} {verb} {rel_type} {to_obj}", set()).update(*from_objs.values())
+    return facts
+
+
+def compact_sub_graph_to_text(graph_dict, observation, choice_ids=(), task='', count_tokens=None, max_tokens=0):
+    """
+    Observation text of the facts most relevant to the choices and the task that fit in max_tokens (0 for no limit).
+    A fact scores 2 for each object of the choices and 1 for each object named in the task it mentions,
+    facts are taken by score and kept in the order of the observation.
+    """
+    facts = observation_facts(graph_dict, observation)
+    if max_tokens <= 0:
+        return '\n'.join(facts)
+    if count_tokens is None:
+        count_tokens = lambda text: len(text) // 4
+    id_to_class_name = {node['id']: node['class_name'] for node in graph_dict['nodes']}
+    task = task.lower()
+    choice_ids = set(choice_ids)
+
+    def relevance(ids):
+        return sum([2 * (_ in choice_ids) + (id_to_class_name[_].replace('_', ' ') in task) for _ in ids])
+    order = {text: idx for idx, text in enumerate(facts)}
+    ranked = sorted(facts, key=lambda text: (-relevance(facts[text]), order[text]))
+    kept, n_tokens = [], 0
+    for text in ranked:
+        # every line is counted with the newline in front of it
+        text_tokens = count_tokens('\n' + text)
+        if n_tokens + text_tokens <= max_tokens:
+            kept.append(text)
+            n_tokens += text_tokens
+    return '\n'.join(sorted(kept, key=lambda text: order[text]))
+
+
 from evolving_graph.scripts import Script, read_script_from_list_string
-def observation_prompt(graph_dict, action_choices): # for grounded deciding
+def observation_prompt(graph_dict, action_choices, spatial_index=None, compact=False, task='', count_tokens=None, max_tokens=0, state=None): # for grounded deciding
     # observation : partial graph_dict
+    # state: the live EnvironmentState of graph_dict, rebuilt from graph_dict when not given
+    # spatial_index: SpatialIndex of graph_dict kept by the caller, built here when not given
+    # compact: render with compact_sub_graph_to_text, trimmed to max_tokens counted by count_tokens
     script_lines = [read_script_from_list_string([c]) for c in action_choices]
-    object_observation = multiple_objects_related_observation(get_object_id_list_from_script(script_lines), _mask_state(graph_dict))
-    ontology_prompt = ontology_observation_prompt(EnvironmentState(EnvironmentGraph(graph_dict), utils.load_name_equivalence(), instance_selection=True))
+    if spatial_index is None:
+        spatial_index = SpatialIndex(graph_dict)
+    object_id_list = get_object_id_list_from_script(script_lines)
+    object_observation = spatial_index.partial_observation(object_id_list)
+    if state is None:
+        state = EnvironmentState(EnvironmentGraph(graph_dict), get_resource('name_equivalence'), instance_selection=True)
+    ontology_prompt = ontology_observation_prompt(state)
     res = ontology_prompt
-    res += '\n' + translate_sub_graph_to_text(graph_dict, object_observation)
+    if compact:
+        res += '\n' + compact_sub_graph_to_text(graph_dict, object_observation, object_id_list, task, count_tokens, max_tokens)
+    else:
+        res += '\n' + translate_sub_graph_to_text(graph_dict, object_observation)
     return res
 
 
 
-def get_env_prompt(graph_dict):
+# scene level prompts, keyed by the content hash of the scene graph (many tasks share the same initial scene)
+# bump ENV_PROMPT_VERSION whenever render_env_prompt renders differently, entries of other versions are never used
+ENV_PROMPT_VERSION = 2
+_env_prompt_cache = {}
+_env_prompt_cache_path = None
+_env_prompt_cache_lock = threading.Lock()
+
+
+def set_env_prompt_cache(path):
+    """
+    Also keep the scene prompts in the json lines file path, shared by the processes and the runs using it.
+    Every rendered scene is appended as one line, lines of other ENV_PROMPT_VERSIONs are skipped when loading.
+    """
+    global _env_prompt_cache_path
+    _env_prompt_cache_path = path
+    if path is None or not os.path.exists(path):
+        return
+    with open(path, 'r', encoding='utf') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:  # a line cut short by a crashed process
+                continue
+            if isinstance(entry, dict) and entry.get('version', None) == ENV_PROMPT_VERSION:
+                _env_prompt_cache[entry['scene']] = entry['prompt']
+
+
+def scene_hash(graph_dict):
+    """
+    Key of the scene prompt of graph_dict, hashing the whole scene: compute it once per scene and pass it to
+    get_env_prompt / plan_generation_prompt / plan_generation_prompt_tokens.
+    """
+    return hashlib.sha1(json.dumps(graph_dict, sort_keys=True).encode('utf')).hexdigest()
+
+
+def _append_env_prompt(path, scene, prompt):
+    # one line per write, under a lock on the file so that the lines of processes appending at the same time
+    # do not interleave, a line cut short by a crash is ended first
+    line = (json.dumps({'version': ENV_PROMPT_VERSION, 'scene': scene, 'prompt': prompt}) + '\n').encode('utf')
+    with open(path, 'ab+') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        end = f.seek(0, os.SEEK_END)
+        if end > 0:
+            f.seek(end - 1)
+            if f.read(1) != b'\n':
+                line = b'\n' + line
+        f.write(line)
+
+
+def get_env_prompt(graph_dict, scene=None):
+    """
+    Scene prompt of graph_dict, scene is its scene_hash if already known.
+    """
+    scene = scene_hash(graph_dict) if scene is None else scene
+    prompt = _env_prompt_cache.get(scene, None)
+    if prompt is None:
+        prompt = render_env_prompt(graph_dict)
+        with _env_prompt_cache_lock:
+            _env_prompt_cache[scene] = prompt
+            if _env_prompt_cache_path is not None:
+                _append_env_prompt(_env_prompt_cache_path, scene, prompt)
+    return prompt
+
+
+def render_env_prompt(graph_dict):
     prompt = ''
     available_rooms_in_graph = [i['class_name'] for i in filter(lambda v: v["category"] == 'Rooms', graph_dict['nodes'])]
     room_num_eng = num_to_eng[len(available_rooms_in_graph)]
     room_str = ', '.join(available_rooms_in_graph)
     prompt += f'You are in a house that consists of {room_num_eng} rooms. These rooms are {room_str}.'
-    name_equivalence = utils.load_name_equivalence()
+    name_equivalence = get_resource('name_equivalence')
     state = EnvironmentState(EnvironmentGraph(graph_dict), name_equivalence)
     prompt += '\n' + ontology_observation_prompt(state) + '\n' + available_object_prompt(graph_dict)
     return prompt
 
 
 def available_object_prompt(graph_dict):
-    objs = list(set([_['class_name'] for _ in graph_dict['nodes']]))
+    # in the order of the nodes, so the same scene gives the same prompt (and response cache key) in every process
+    objs = list(dict.fromkeys([_['class_name'] for _ in graph_dict['nodes']]))
     obj_prompt = ', '.join(objs)
     return f'Available objects in the house are : {obj_prompt}\nAll object names must be chosen from the above object list'
 
 
-def plan_generation_prompt(graph_dict, prefix_path):
-    prefix = ''.join(open(prefix_path, 'r', encoding='utf').readlines())
-    prompt = prefix + '\n' + get_env_prompt(graph_dict)
+# prompt layouts, the prompt files give the prefix
+PLAN_GENERATION_LAYOUT = PromptLayout('{prefix}\n{environment}')
+PLAN_GENERATION_CODE_LAYOUT = PromptLayout('{prefix}\n"""\n{environment}\n"""')
+GROUNDED_DECIDING_LAYOUT = PromptLayout('{prefix}\nYour current observation is: {observation}\nYour task is: {task}\n{history}\n{error_info}{choices}\n{answer}')
+
+
+def plan_generation_prompt(graph_dict, prefix_path, scene=None):
+    prompt = PLAN_GENERATION_LAYOUT.fill(prefix=get_prompt_file(prefix_path).text, environment=get_env_prompt(graph_dict, scene))
     # print('-'*10 + 'Plan Generation Prompt' + '-'*10)
     # print(prompt)
     return prompt
     # open(out_path, 'w', encoding='utf').write(prompt)
 
+
+def plan_generation_prompt_tokens(graph_dict, prefix_path, prompt_builder, scene=None):
+    """
+    Number of tokens of plan_generation_prompt(graph_dict, prefix_path), from the count kept with the prompt file
+    and the cached count of the scene prompt (the two pieces of PLAN_GENERATION_LAYOUT).
+    """
+    prompt_file = get_prompt_file(prefix_path)
+    environment = '\n' + get_env_prompt(graph_dict, scene)
+    if not PromptBuilder.joins_exactly(prompt_file.text, environment):
+        return prompt_builder.count_tokens(plan_generation_prompt(graph_dict, prefix_path, scene))
+    return prompt_file.count_tokens(prompt_builder.tokenizer) + prompt_builder.count_tokens(environment)
+
 def plan_generation_prompt_code(graph_dict, prefix_path):
-    prefix = ''.join(open(prefix_path, 'r', encoding='utf').readlines())
-    prompt = prefix + f'\n\"\"\"\n{get_env_prompt(graph_dict)}\n\"\"\"'
+    prompt = PLAN_GENERATION_CODE_LAYOUT.fill(prefix=get_prompt_file(prefix_path).text, environment=get_env_prompt(graph_dict))
     # print('-'*10 + 'Plan Generation Prompt' + '-'*10)
     # print(prompt)
     return prompt
@@ -230,7 +481,37 @@ def progprompt_prompt(graph_dict, ):
     pass
 
 
-def grounded_deciding_prompt(args, graph_dict, task, action_choices, past_actions, error_info=''):
+# choice labels of grounded deciding: A..Z, then AA, AB, .. for larger trees (the first 26 labels are unchanged)
+CHOICE_LABEL_PATTERN = re.compile(r'[A-Z]+')
+
+
+def choice_label(idx):
+    label = ''
+    idx += 1
+    while idx > 0:
+        idx, r = divmod(idx - 1, 26)
+        label = chr(65 + r) + label
+    return label
+
+
+def choice_index(label):
+    idx = 0
+    for c in label:
+        idx = idx * 26 + ord(c) - 64
+    return idx - 1
+
+
+def parse_choice_label(text, n_choices=26):
+    """
+    The choice label a reply starts with, '' if there is none. Up to 26 choices only the first letter is read, as before.
+    """
+    match = CHOICE_LABEL_PATTERN.match(text.strip().replace('.', ''))
+    if match is None:
+        return ''
+    return match.group()[:1] if n_choices <= 26 else match.group()
+
+
+def grounded_deciding_prompt(args, graph_dict, task, action_choices, past_actions, error_info='', spatial_index=None, prompt_builder=None, state=None):
     obj_action_choices = copy.deepcopy(action_choices)
     if isinstance(action_choices[0], list):
         t = []
@@ -242,8 +523,14 @@ def grounded_deciding_prompt(args, graph_dict, task, action_choices, past_action
     if '[END]' in obj_action_choices:
         obj_action_choices.remove('[END]')
     prefix_path = args.grounded_deciding_prompt_path if args.retry_times == 0 else args.grounded_deciding_prompt_path[:-4] + '_error_correction.txt'
-    prefix = ''.join(open(prefix_path, 'r', encoding='utf').readlines())
-    env_prompt = observation_prompt(graph_dict, obj_action_choices)
+    env_prompt = observation_prompt(
+        graph_dict, obj_action_choices, spatial_index,
+        compact=args.observation_format == 'compact',
+        task=task,
+        count_tokens=prompt_builder.count_tokens if prompt_builder is not None else None,
+        max_tokens=args.max_observation_tokens,
+        state=state
+    )
     if len(past_actions) > 0:
         past_experience_prompt = '\n'.join(past_actions)
         past_experience_prompt = f'You have executed the following sub-tasks: \n{past_experience_prompt}'
@@ -251,9 +538,7 @@ def grounded_deciding_prompt(args, graph_dict, task, action_choices, past_action
         past_experience_prompt = f'This is the first sub-task you need to execute'
     # action_prompt = '\n'.join(action_choices)
     # @mengkang A. xxx B. xxx
-    alphabet = [chr(_) for _ in list(range(65, 91))]
-    def get_chr(idx):
-        return alphabet[idx]
+    get_chr = choice_label
     if isinstance(action_choices[0], list): # sequence version of implementation. can be deleted if the performance is worse
         def get_seq_str(a):
             return ' | '.join(a)
@@ -261,10 +546,13 @@ def grounded_deciding_prompt(args, graph_dict, task, action_choices, past_action
     else:
         action_prompt = '\n'.join([f'{get_chr(idx)}. {a}' for idx, a in enumerate(action_choices)])
     action_prompt = f'Among the following sub-tasks (or sub-task sequence), which one would you take.\n{action_prompt}'
-    prompt = prefix + f'\nYour current observation is: {env_prompt}' + f'\nYour task is: {task}' + f'\n{past_experience_prompt}'
-    if error_info == '':
-        prompt = prompt + f'\n{action_prompt}' + f'\nThe best choice of sub-task is:\n'
-    else:
-        prompt = prompt + '\n' + error_info + f'\n{action_prompt}' + '\nA corrective choice of sub-task would be:\n'
-    return prompt
+    return GROUNDED_DECIDING_LAYOUT.fill(
+        prefix=get_prompt_file(prefix_path).text,
+        observation=env_prompt,
+        task=task,
+        history=past_experience_prompt,
+        error_info=error_info + '\n' if error_info != '' else '',
+        choices=action_prompt,
+        answer='The best choice of sub-task is:\n' if error_info == '' else 'A corrective choice of sub-task would be:\n'
+    )
 
@@ -1,5 +1,6 @@
 import copy
 import json
+import math
 import sys
 import os
 ROOT_DIR = os.path.join(os.path.dirname(__file__))
@@ -18,14 +19,23 @@ from evolving_graph.preparation import AddMissingScriptObjects, AddRandomObjects
 import add_preconds
 from evolving_graph.check_programs import modify_objects_unity2script
 from evolving_graph.custom_graph_dict_helper import custom_graph_dict_helper
+from evolving_graph.resources import get_resource
 from evolving_graph.custom_executor import CustomScriptExecutor
 from sampling_grounding_deciding.utils.data_utils import del_graph
+from sampling_grounding_deciding.utils.state_history import GraphStateList, StateView, graph_delta, state_extras, restore_state_extras
+from sampling_grounding_deciding.utils.env_utils import CHOICE_LABEL_PATTERN, choice_label, choice_index, parse_choice_label
 
 
 # get script prepared for execution (map the id in script (like (1) or (2)) to the exact object id ((237)) in the environment)
 def prepare_for_execution(graph_dict, script):
     max_nodes = 400
-    helper = custom_graph_dict_helper(max_nodes=max_nodes)
+    # the resources of the helper are parsed once per process
+    helper = custom_graph_dict_helper(
+        properties_data=get_resource('properties_data'),
+        object_placing=get_resource('object_placing'),
+        object_states=get_resource('object_states'),
+        max_nodes=max_nodes
+    )
     helper.initialize(graph_dict)
     # what modify_objects_unity2script do except precond
     # script, precond = modify_objects_unity2script(helper, script, precond)
@@ -63,11 +73,11 @@ def exec_script(script_str, graph_dict, verbose=False):
         return False, None, None, str(e)
     # exec
     graph = EnvironmentGraph(graph_dict)
-    name_equivalence = utils.load_name_equivalence()
+    name_equivalence = get_resource('name_equivalence')
     executor = ScriptExecutor(graph, name_equivalence)
     info = executor.info
     state = EnvironmentState(executor.graph, executor.name_equivalence, instance_selection=True)
-    graph_state_list = []
+    graph_state_list = GraphStateList()
     for i in range(len(script)):
         prev_state = state
         graph_state_list.append(state.to_dict())
@@ -90,6 +100,70 @@ def calc_gcr(init_graph_dict, final_graph_dict, goal_condition):
     # print(gold_edges, gold_nodes)
     return (len(set(edge_list) & set(gold_edges)) + len(set(node_list) & set(gold_nodes))) / s
 
+
+class GoalTracker:
+    """
+    calc_gcr(init_graph_dict, graph_dict, goal_condition) of the states of an execution, updated from the deltas between
+    consecutive states (see GraphStateList) in time proportional to the changes instead of comparing full graph dicts.
+    As in del_graph, only gold edges (other than CLOSE) and node states missing from the initial graph can be satisfied.
+    """
+
+    def __init__(self, init_graph_dict, goal_condition):
+        gold_edges, gold_nodes = goal_condition
+        self.n_conditions = len(gold_edges) + len(gold_nodes)
+        self.class_names = {n['id']: n['class_name'] for n in init_graph_dict['nodes']}
+        init_edges = {(e['from_id'], e['to_id'], e['relation_type'], self.class_names[e['from_id']], self.class_names[e['to_id']]) for e in init_graph_dict['edges']}
+        init_nodes = {(n['id'], n['class_name'], s) for n in init_graph_dict['nodes'] for s in n['states']}
+        self.edge_goals = {}    # (from_id, relation_type, to_id) -> gold edges
+        for g in set([tuple(_) for _ in gold_edges]):
+            if g[2] != 'CLOSE' and g not in init_edges:
+                self.edge_goals.setdefault((g[0], g[2], g[1]), []).append(g)
+        self.node_goals = {}    # node id -> gold node states
+        for g in set([tuple(_) for _ in gold_nodes]):
+            if g not in init_nodes:
+                self.node_goals.setdefault(g[0], []).append(g)
+        self.satisfied = set()
+
+    def update(self, delta, undo=False):
+        """
+        Apply the delta of a step (undo it if undo) and return the goal condition rate of the new state.
+        """
+        for node_id, (before, after) in delta['nodes'].items():
+            node = before if undo else after
+            if node is not None:
+                self.class_names[node_id] = node['class_name']
+            for g in self.node_goals.get(node_id, []):
+                if node is not None and node['class_name'] == g[1] and g[2] in node['states']:
+                    self.satisfied.add(g)
+                else:
+                    self.satisfied.discard(g)
+        added, removed = (delta['removed_edges'], delta['added_edges']) if undo else (delta['added_edges'], delta['removed_edges'])
+        for key in removed:
+            for g in self.edge_goals.get(key, []):
+                self.satisfied.discard(g)
+        for key in added:
+            for g in self.edge_goals.get(key, []):
+                if self.class_names.get(g[0], None) == g[3] and self.class_names.get(g[1], None) == g[4]:
+                    self.satisfied.add(g)
+        return self.gcr()
+
+    def gcr(self):
+        return len(self.satisfied) / self.n_conditions
+
+    def success(self):
+        return abs(self.gcr() - 1) < 1e-5
+
+
+def calc_gcr_list(init_graph_dict, graph_state_list, goal_condition):
+    """
+    calc_gcr of every state of a GraphStateList, computed from its deltas.
+    """
+    tracker = GoalTracker(init_graph_dict, goal_condition)
+    gcr_list = [tracker.update(graph_delta(init_graph_dict, graph_state_list[0]))]
+    for delta in graph_state_list.deltas():
+        gcr_list.append(tracker.update(delta))
+    return gcr_list
+
 import traceback
 def calc_metrics(script_str, graph_dict, goal_condition, verbose=True):
     def float_equal(a, b):
@@ -99,7 +173,7 @@ def calc_metrics(script_str, graph_dict, goal_condition, verbose=True):
     try:
         executability, state, graph_state_list, info = exec_script(script_str, init_graph_dict, False)
         if executability:
-            gcr = calc_gcr(init_graph_dict, state.to_dict(), goal_condition)
+            gcr = calc_gcr(init_graph_dict, graph_state_list[-1], goal_condition)    # the final state, already serialized
             metric_list.append((int(executability), gcr))
         elif verbose:
             print(info)
@@ -116,7 +190,6 @@ def calc_metrics(script_str, graph_dict, goal_condition, verbose=True):
 
 
 def most_freq(seq):
-    chrs = {chr(_) for idx, _ in enumerate(list(range(65, 91)))}
     freq_map = {}
     for _ in seq:
         if _ not in freq_map:
@@ -124,7 +197,7 @@ def most_freq(seq):
         freq_map[_] += 1
     ignored_keys = []
     for k, v in freq_map.items():
-        if k not in chrs:
+        if CHOICE_LABEL_PATTERN.fullmatch(k) is None:
             # freq_map.pop(k)
             ignored_keys.append(k)
     for k in ignored_keys:
@@ -136,6 +209,109 @@ def post_process_of_generated_action(g):
     return g.strip().replace('.', '')
 
 
+def vote_decided(votes, n_remaining, confidence=1.0):
+    """
+    Whether the majority of votes (valid choice labels) is settled: the remaining votes cannot change the winner,
+    or the winner already holds a confidence share of the votes.
+    """
+    counts = sorted([votes.count(_) for _ in set(votes)], reverse=True) + [0, 0]
+    if counts[0] - counts[1] > n_remaining:     # strict, a tie could be broken differently
+        return True
+    return confidence < 1.0 and len(votes) > 0 and counts[0] / len(votes) >= confidence
+
+
+def rank_votes(votes):
+    """
+    Choice labels ranked by their share of votes, ties are ranked by first appearance as in most_freq.
+    """
+    counts = {}
+    for _ in votes:
+        counts[_] = counts.get(_, 0) + 1
+    return [(c, v / len(votes)) for c, v in sorted(counts.items(), key=lambda x:x[1], reverse=True)]
+
+
+def sequential_vote(args, generator, g_eid, prompt, n_choices=26):
+    """
+    Majority vote over at most args.sampling_n samples drawn args.vote_batch_size at a time, stopping as soon as
+    the vote is decided (see vote_decided). All samples are drawn in one request when args.vote_batch_size == 0
+    or when the backend does not reuse the prompt prefix.
+    Return (ranked [(choice label, share of votes)], generated labels, number of samples drawn, total tokens).
+    """
+    chrs = {choice_label(_) for _ in range(n_choices)}
+    batch_size = args.vote_batch_size if args.vote_batch_size > 0 and generator.backend.reuses_prompt_prefix else args.sampling_n
+    llm_gen, votes, n_drawn, usage_all = [], [], 0, 0
+    while n_drawn < args.sampling_n:
+        cur_n = min(batch_size, args.sampling_n - n_drawn)
+        response_dict, usage = generator.generate_one_pass(
+            prompts=[(g_eid, prompt)],
+            verbose=False,
+            n=cur_n,
+            sample_offset=n_drawn
+        )
+        n_drawn += cur_n
+        usage_all += usage['total_tokens']
+        cur_gen = [parse_choice_label(_[0], n_choices) for _ in response_dict.get(g_eid, [])]
+        llm_gen += cur_gen
+        votes += [_ for _ in cur_gen if _ in chrs]
+        if vote_decided(votes, args.sampling_n - n_drawn, args.vote_confidence):
+            break
+    return rank_votes(votes), llm_gen, n_drawn, usage_all
+
+
+def logprob_choice_scores(args, generator, g_eid, prompt, n_choices=26):
+    """
+    Score the choices with the top logprobs of the first answer token of a single sample.
+    Letters missing from the top logprobs share the probability mass left, the scores are normalized over the
+    choice letters. Engines without logprobs (chat) and prompts with more than 26 choices (labels of several tokens)
+    go to sequential_vote.
+    Return (ranked [(choice label, probability)], number of samples drawn, total tokens).
+    """
+    if n_choices > 26 or not generator._is_completion_engine(args.engine):
+        ranked, _, n_samples, vote_usage = sequential_vote(args, generator, g_eid, prompt, n_choices)
+        return ranked, n_samples, vote_usage
+    chrs = [choice_label(_) for _ in range(n_choices)]
+    response_dict, usage = generator.generate_one_pass(
+        prompts=[(g_eid, prompt)],
+        verbose=False,
+        n=1,
+        logprobs=args.top_logprobs
+    )
+    text, logprobs = response_dict[g_eid][0]
+    if not logprobs:
+        ranked, _, n_samples, vote_usage = sequential_vote(args, generator, g_eid, prompt, n_choices)
+        return ranked, n_samples + 1, usage['total_tokens'] + vote_usage
+    # the answer letter is the first token that is not blank
+    top = {}
+    for token, top_logprobs in zip(logprobs['tokens'], logprobs['top_logprobs']):
+        if token.strip() != '':
+            top = top_logprobs or {}
+            break
+    probs = {}
+    for token, lp in top.items():
+        c = token.strip().replace('.', '')
+        if c in chrs:
+            probs[c] = probs.get(c, 0) + math.exp(lp)
+    missing = [c for c in chrs if c not in probs]
+    left = max(0.0, 1 - sum([math.exp(lp) for lp in top.values()]))
+    for c in missing:
+        probs[c] = left / len(missing)
+    total = sum(probs.values())
+    ranked = sorted([(c, p / total if total > 0 else 1 / len(chrs)) for c, p in probs.items()], key=lambda x:x[1], reverse=True)
+    return ranked, 1, usage['total_tokens']
+
+
+def score_choices(args, generator, g_eid, prompt, n_choices):
+    """
+    Ranked [(choice label, probability)] of the choices of a grounded deciding prompt, by args.choice_scoring.
+    Return (ranked choices, number of samples drawn, total tokens).
+    """
+    if args.choice_scoring == 'logprob':
+        return logprob_choice_scores(args, generator, g_eid, prompt, n_choices)
+    ranked, llm_gen, n_samples, usage = sequential_vote(args, generator, g_eid, prompt, n_choices)
+    print(llm_gen)
+    return ranked, n_samples, usage
+
+
 def construct_error_info(past_error_info, error_info, step):
     cur_error_info = f'The sub-task: \"{step}\" caused an error: {error_info}'
     if past_error_info != '':
@@ -161,7 +337,8 @@ def construct_gd_error_info(past_error_info, error_info, step):
 
 
 from sampling_grounding_deciding.utils.deciding_graph import Deciding_Tree
-from sampling_grounding_deciding.utils.env_utils import grounded_deciding_prompt
+from sampling_grounding_deciding.utils.env_utils import grounded_deciding_prompt, SpatialIndex
+from generation.prompt import PromptBuilder
 
 def grounded_exec(args, script_str_list, graph_dict, task, generator, g_eid, goal_conditions, verbose=False):
     max_retry_times, retry_cnt = args.retry_times, 0    # when retry_times == 0, do not do error correction
@@ -170,7 +347,7 @@ def grounded_exec(args, script_str_list, graph_dict, task, generator, g_eid, goa
     # prepare environment and executor
     init_graph_dict = copy.deepcopy(graph_dict)
     graph = EnvironmentGraph(graph_dict)
-    name_equivalence = utils.load_name_equivalence()
+    name_equivalence = get_resource('name_equivalence')
     executor = ScriptExecutor(graph, name_equivalence)
     info = executor.info
     state = EnvironmentState(executor.graph, executor.name_equivalence, instance_selection=True)
@@ -190,24 +367,39 @@ def grounded_exec(args, script_str_list, graph_dict, task, generator, g_eid, goa
     dt = Deciding_Tree(script_str_list_aligned, task)
     node = dt.start_point()
 
-    graph_state_list, state_traceback = [], []
+    graph_state_list = GraphStateList()    # also the states of the layers for backtracking, rebuilt from their graph dicts and extras
+    state_extras_list = []  # the fields of the state of every layer that the graph dicts do not keep
+    goal_tracker = GoalTracker(init_graph_dict, goal_conditions)   # follows the last graph dict of graph_state_list
+    state_view = StateView(state)  # the graph dict of the current state, serialized once
+    graph_state_list.append(state_view.to_dict())
+    state_extras_list.append(state_extras(state))
+    goal_tracker.update(graph_delta(init_graph_dict, graph_state_list[0]))
+    spatial_index = SpatialIndex(graph_state_list[0])   # follows the last graph dict of graph_state_list through its deltas
+    prompt_builder = PromptBuilder(generator.tokenizer, sep='\n') if generator.tokenizer is not None else None    # token counts of observation lines
     plan = []
     _traceback = []
     usage_all = 0
-    chr_to_idx = {chr(_):idx for idx, _ in enumerate(list(range(65, 91)))}
     # for t in range(dt.max_steps):
     while True:
         error_info = '' # for prompting error correction
         prev_state = state
-        graph_state_list.append(state.to_dict())
-        state_traceback.append(copy.deepcopy(state))
         while True:
             # choices = dg.choices_at_t(t)
             # choices = node.get_choices()
             choices = node.get_valid_choices()
+            fallback = None
             if len(choices) == 1:
                 choice = choices[0]
                 prompt = ''
+                n_samples = 0
+                ranked = [('A', 1.0)]
+            elif args.requery_policy == 'fallback' and node.get_fallback_choice(args.requery_threshold) is not None:
+                # a retry at this node, take the next best valid choice of the previous decision instead of asking again
+                fallback = choice = node.get_fallback_choice(args.requery_threshold)
+                prompt = ''
+                n_samples = 0
+                ranked = []
+                print(f'Fall back to {choice}')
             else:
                 # seq version
                 if args.prompt_choices_sequence:
@@ -217,29 +409,27 @@ def grounded_exec(args, script_str_list, graph_dict, task, generator, g_eid, goa
                 # original version
                 else:
                     prompt_choices = choices
-                prompt = grounded_deciding_prompt(args, state.to_dict(), task, prompt_choices, plan, error_info)
+                current_graph_dict = state_view.to_dict()
+                prompt = grounded_deciding_prompt(args, current_graph_dict, task, prompt_choices, plan, error_info, spatial_index, prompt_builder, state_view.state)
                 print(prompt)
-                response_dict, usage = generator.generate_one_pass(
-                    prompts=[(g_eid, prompt)],
-                    verbose=False
-                )
-                usage_all += usage['total_tokens']
                 # @mengkang alpha choice selection
-                llm_gen = [_[0].strip().replace('.', '')[:1] for _ in response_dict[g_eid]]
-                print(llm_gen)
-                c = most_freq(llm_gen)
-                choice = choices[chr_to_idx[c]]
+                ranked, n_samples, usage = score_choices(args, generator, g_eid, prompt, len(prompt_choices))
+                usage_all += usage
+                print(ranked)
+                choice = choices[choice_index(ranked[0][0])]
+                node.set_choice_probs({choices[choice_index(c)]: p for c, p in ranked})
                 print(choice)
             # print(choice)
             if choice == '[END]':   # end of execution (success)
                 end_of_execution = 'success'
                 break
             candidate_node = node.find_son_by_action(action=choice)
-            _traceback.append({'action': choice, 'prompt':prompt})
+            _traceback.append({'action': choice, 'prompt':prompt, 'n_samples': n_samples, 'choice_probs': ranked, 'fallback': fallback is not None})
             # exec
             future_script = read_script_from_string(choice)
             # future_script = script_list[dg.get_idx_list(choice, t)[0]].from_index(t)
             executability, state = exec_one_step(future_script, state, executor)
+            state_view.set(state)
             if not executability:
                 if verbose: print(executor.info.get_error_string())
                 if retry_cnt >= max_retry_times:    # end of execution (failed)
@@ -271,16 +461,24 @@ def grounded_exec(args, script_str_list, graph_dict, task, generator, g_eid, goa
                         error_info = construct_gd_error_info(error_info, executor.info.messages[-1], '|'.join(traceback_plan))
                         # recover state
                         t = node.layer_id + 1
-                        state = state_traceback[t]
-                        state_traceback = state_traceback[:t+1]
-                        graph_state_list = graph_state_list[:t+1]
+                        for delta in graph_state_list.truncate(t + 1):
+                            goal_tracker.update(delta, undo=True)
+                            spatial_index.apply_delta(delta, undo=True)
+                        state_extras_list = state_extras_list[:t+1]
+                        state = EnvironmentState(EnvironmentGraph(graph_state_list[t]), name_equivalence, instance_selection=True)
+                        restore_state_extras(state, state_extras_list[t])
+                        state_view.set(state, graph_state_list[t])
                         plan = plan[:t+1]
                         print(node.action_str, plan)
                         continue
             else:
                 node = candidate_node
-                current_graph_dict = state.to_dict()
-                if abs(calc_gcr(init_graph_dict, current_graph_dict, goal_conditions) - 1) < 1e-5:
+                # the new state starts the next layer
+                delta = graph_state_list.append(state_view.to_dict())
+                state_extras_list.append(state_extras(state, state_extras_list[-1]))
+                goal_tracker.update(delta)
+                spatial_index.apply_delta(delta)
+                if goal_tracker.success():
                     end_of_execution = 'success'
             break
         # _traceback.append({'action': choice, 'prompt':prompt})
@@ -288,7 +486,8 @@ def grounded_exec(args, script_str_list, graph_dict, task, generator, g_eid, goa
             plan.append(choice)
         if end_of_execution in ['success', 'failed']:
             if end_of_execution == 'success':
-                graph_state_list.append(state.to_dict())
+                if choice == '[END]':   # the last state is listed twice, as when the goal is reached
+                    graph_state_list.append(state_view.to_dict())
                 return True, state, graph_state_list, '', plan, usage_all, _traceback, retry_cnt, node.idx_list
             else:
                 return False, state, graph_state_list, return_error_info, plan, usage_all, _traceback, retry_cnt, []
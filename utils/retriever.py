@@ -4,6 +4,7 @@ import torch
 from sentence_transformers import SentenceTransformer
 from sentence_transformers import util as st_utils
 import pickle as pkl
+import hashlib
 import numpy as np
 
 
@@ -22,4 +23,70 @@ class Retriever:
         sorted_idx = np.argsort(-np.array(cos_scores))
         top_k_idx = sorted_idx[:topk]
         top_k_scores = cos_scores[top_k_idx]
-        return top_k_idx, top_k_scores
\ No newline at end of file
+        return top_k_idx, top_k_scores
+
+
+class EmbeddingIndex:
+    """
+    Normalized embeddings of a text corpus kept in a .npz file, searched with numpy on CPU.
+    The file stores a fingerprint of the corpus and the model, it is rebuilt when either changes.
+    """
+    def __init__(self, embeddings, fingerprint):
+        self.embeddings = embeddings
+        self.fingerprint = fingerprint
+
+    @staticmethod
+    def make_fingerprint(text_list, model_name):
+        return hashlib.sha1(json.dumps([model_name, text_list]).encode('utf')).hexdigest()
+
+    @staticmethod
+    def normalize(embeddings):
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        return embeddings / np.maximum(np.linalg.norm(embeddings, axis=-1, keepdims=True), 1e-12)
+
+    @classmethod
+    def load_or_build(cls, path, text_list, retriever=None, model_name='stsb-roberta-large'):
+        """
+        Load the index saved at path, or encode text_list with retriever (created if None) and save it.
+        """
+        fingerprint = cls.make_fingerprint(text_list, model_name)
+        if os.path.exists(path):
+            saved = np.load(path)
+            if str(saved['fingerprint']) == fingerprint:
+                return cls(saved['embeddings'], fingerprint)
+        if retriever is None:
+            retriever = Retriever(model_name=model_name)
+        embeddings = cls.normalize(retriever.init_corpus_embedding(text_list).detach().cpu().numpy())
+        if os.path.dirname(path) != '':
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        np.savez(path, embeddings=embeddings, fingerprint=np.array(fingerprint))
+        return cls(embeddings, fingerprint)
+
+    def search(self, query_embeddings, topk=1):
+        """
+        Indices and cosine scores of the topk most similar corpus entries of every query, most similar first.
+        """
+        scores = self.normalize(query_embeddings) @ self.embeddings.T
+        topk = min(topk, scores.shape[-1])
+        top_k_idx = np.argsort(-scores, axis=-1, kind='stable')[:, :topk]
+        return top_k_idx, np.take_along_axis(scores, top_k_idx, axis=-1)
+
+
+def task_to_idx_fingerprint(tasks, retrieval_dataset, topk, model_name='stsb-roberta-large'):
+    """
+    Fingerprint of what build_task_to_idx computes from, saved with its result to detect a stale example_idx_file.
+    """
+    return hashlib.sha1(json.dumps([model_name, topk, sorted(set(tasks)), [_['task'] for _ in retrieval_dataset]]).encode('utf')).hexdigest()
+
+
+def build_task_to_idx(tasks, retrieval_dataset, index_path, topk, model_name='stsb-roberta-large'):
+    """
+    Map every task to the indices of its topk most similar tasks in retrieval_dataset (few-shot exemplars).
+    The retrieval dataset embeddings are saved at index_path, the queries are encoded in one batch.
+    """
+    retriever = Retriever(model_name=model_name)
+    index = EmbeddingIndex.load_or_build(index_path, [_['task'] for _ in retrieval_dataset], retriever, model_name)
+    tasks = sorted(set(tasks))
+    query_embeddings = retriever.init_corpus_embedding(tasks).detach().cpu().numpy()
+    top_k_idx, _ = index.search(query_embeddings, topk)
+    return {task: [int(i) for i in idx] for task, idx in zip(tasks, top_k_idx)}
@@ -0,0 +1,189 @@
+# Graph dict views of execution states, and histories of them stored as changes between consecutive states
+import copy
+
+# fields of an EnvironmentState that its graph dict does not keep: the script object -> node id bindings and the
+# data executors keep between actions. A state rebuilt from a graph dict starts with them empty.
+STATE_EXTRA_FIELDS = ('_script_objects', 'executor_data')
+
+
+def state_extras(state, previous=None):
+    """
+    Copy of the fields of state missing from its graph dict (see STATE_EXTRA_FIELDS), for restore_state_extras.
+    previous is the result for the layer before, a field (or an entry of a dict field) equal to it is shared instead
+    of copied again, so a step only copies what it changed. The results are never modified.
+    """
+    previous = previous or {}
+    extras = {}
+    for name in STATE_EXTRA_FIELDS:
+        if not hasattr(state, name):
+            continue
+        value, prev = getattr(state, name), previous.get(name, None)
+        if prev is not None and value == prev:
+            extras[name] = prev
+        elif isinstance(value, dict) and isinstance(prev, dict):
+            extras[name] = {k: prev[k] if k in prev and prev[k] == v else copy.deepcopy(v) for k, v in value.items()}
+        else:
+            extras[name] = copy.deepcopy(value)
+    return extras
+
+
+def restore_state_extras(state, extras):
+    """
+    Give a state rebuilt from a graph dict the fields saved by state_extras, return state.
+    The saved fields are copied again, the same extras can be restored on every backtrack to their layer.
+    """
+    for name, value in extras.items():
+        setattr(state, name, copy.deepcopy(value))
+    return state
+
+
+class StateView:
+    """
+    The live state of an execution with its graph dict, serialized at most once per state.
+    The executor returns a new state object for every action that changes something, so the dict is rebuilt only when
+    set() is given another state.
+    """
+
+    def __init__(self, state):
+        self.state = None
+        self._graph_dict = None
+        self.set(state)
+
+    def set(self, state, graph_dict=None):
+        """
+        Move to state, graph_dict is its graph dict if already known.
+        """
+        if state is not self.state:
+            self.state = state
+            self._graph_dict = graph_dict
+
+    def to_dict(self):
+        if self._graph_dict is None:
+            self._graph_dict = self.state.to_dict()
+        return self._graph_dict
+
+
+def edge_key(edge):
+    return edge['from_id'], edge['relation_type'], edge['to_id']
+
+
+def _index(graph_dict):
+    return {node['id']: node for node in graph_dict['nodes']}, {edge_key(edge): edge for edge in graph_dict['edges']}
+
+
+def _delta(nodes, edges, new_nodes, new_edges):
+    changed_nodes = {node_id: (node, new_nodes.get(node_id, None)) for node_id, node in nodes.items() if new_nodes.get(node_id, None) != node}
+    changed_nodes.update({node_id: (None, node) for node_id, node in new_nodes.items() if node_id not in nodes})
+    return {
+        'nodes': changed_nodes,
+        'added_edges': {key: edge for key, edge in new_edges.items() if key not in edges},
+        'removed_edges': {key: edge for key, edge in edges.items() if key not in new_edges},
+    }
+
+
+def graph_delta(graph_dict, new_graph_dict):
+    """
+    Delta leading from graph_dict to new_graph_dict, in the format of GraphStateList.
+    """
+    return _delta(*_index(graph_dict), *_index(new_graph_dict))
+
+
+class GraphStateList:
+    """
+    List of the graph dicts of the states of an execution (graph_state_list), delta-encoded.
+    Only the first and the last graph dicts are kept whole, every step in between is a delta
+    {'nodes': {node id: (node before or None, node after or None)}, 'added_edges': {key: edge}, 'removed_edges': {key: edge}}.
+    Graph dicts are rebuilt on access from the closer end. Metric code can read the deltas directly (see deltas()).
+    Graph dicts given to append() must not be modified afterwards, their nodes and edges are shared.
+    """
+
+    def __init__(self):
+        self._first = None
+        self._last = None
+        self.nodes = {}     # node id -> node of the last graph dict
+        self.edges = {}     # edge key -> edge of the last graph dict
+        self._deltas = []
+
+    def __len__(self):
+        return 0 if self._first is None else len(self._deltas) + 1
+
+    def append(self, graph_dict):
+        """
+        Add graph_dict and return the delta from the previous graph dict (None for the first one).
+        """
+        nodes, edges = _index(graph_dict)
+        delta = None
+        if self._first is None:
+            self._first = graph_dict
+        else:
+            delta = _delta(self.nodes, self.edges, nodes, edges)
+            self._deltas.append(delta)
+        self._last = graph_dict
+        self.nodes, self.edges = nodes, edges
+        return delta
+
+    @staticmethod
+    def _apply(delta, nodes, edges, undo=False):
+        for node_id, (before, after) in delta['nodes'].items():
+            node = before if undo else after
+            if node is None:
+                del nodes[node_id]
+            else:
+                nodes[node_id] = node
+        added, removed = (delta['removed_edges'], delta['added_edges']) if undo else (delta['added_edges'], delta['removed_edges'])
+        for key in removed:
+            del edges[key]
+        edges.update(added)
+
+    def __getitem__(self, idx):
+        n = len(self)
+        if idx < 0:
+            idx += n
+        if not 0 <= idx < n:
+            raise IndexError('graph state index out of range')
+        if idx == 0:
+            return self._first
+        if idx == n - 1:
+            return self._last
+        if idx < n - 1 - idx:
+            nodes, edges = _index(self._first)
+            for delta in self._deltas[:idx]:
+                self._apply(delta, nodes, edges)
+        else:
+            nodes, edges = dict(self.nodes), dict(self.edges)
+            for delta in reversed(self._deltas[idx:]):
+                self._apply(delta, nodes, edges, undo=True)
+        return {'nodes': list(nodes.values()), 'edges': list(edges.values())}
+
+    def __iter__(self):
+        if self._first is None:
+            return
+        yield self._first
+        nodes, edges = _index(self._first)
+        for idx, delta in enumerate(self._deltas):
+            if idx == len(self._deltas) - 1:
+                yield self._last
+                break
+            self._apply(delta, nodes, edges)
+            yield {'nodes': list(nodes.values()), 'edges': list(edges.values())}
+
+    def deltas(self):
+        """
+        The deltas between consecutive graph dicts, deltas()[t] leads from self[t] to self[t + 1].
+        """
+        return list(self._deltas)
+
+    def truncate(self, n):
+        """
+        Keep the first n graph dicts, the last one is rebuilt by undoing the later deltas.
+        Return the dropped deltas, the last one first.
+        """
+        assert 1 <= n <= len(self)
+        dropped = []
+        if n == len(self):
+            return dropped
+        while len(self._deltas) > n - 1:
+            dropped.append(self._deltas.pop())
+            self._apply(dropped[-1], self.nodes, self.edges, undo=True)
+        self._last = self._first if n == 1 else {'nodes': list(self.nodes.values()), 'edges': list(self.edges.values())}
+        return dropped